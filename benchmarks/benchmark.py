@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""
+Measure the duplicate code detection tool end to end on synthetic source trees.
+
+A source tree of every requested size is generated, with files in all the
+supported languages that share a vocabulary and contain blocks copied from each
+other. The tool is then run on every tree in a process of its own, so the peak
+memory of every run is measured separately, and the time, throughput, memory and
+the breakdown per stage (see --profile) of every run are appended as a JSON line
+to the results file, so runs of different versions can be compared.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+
+repository_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+tool_path = os.path.join(repository_dir, "duplicate_code_detection.py")
+sys.path.insert(0, repository_dir)
+import duplicate_code_detection  # noqa: E402
+
+default_scales = [1000, 10000, 50000]
+language_extensions = ["py", "c", "h", "cpp", "java", "cs"]
+operators = ["+", "-", "*", "/", "%", "&", "|", "^"]
+comparisons = ["<", ">", "<=", ">=", "==", "!="]
+
+
+def get_vocabulary(vocabulary_size, rng):
+    """Get random identifiers, with Zipf-like weights so a few are very common"""
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    vocabulary = set()
+    while len(vocabulary) < vocabulary_size:
+        length = rng.randint(3, 12)
+        vocabulary.add("".join(rng.choice(letters) for _ in range(length)))
+    vocabulary = sorted(vocabulary)
+    rng.shuffle(vocabulary)
+    cumulative_weights = list()
+    total_weight = 0.0
+    for rank in range(len(vocabulary)):
+        total_weight += 1.0 / (rank + 1)
+        cumulative_weights.append(total_weight)
+    return vocabulary, cumulative_weights
+
+
+def generate_function(language, words, rng, body_lines):
+    """Generate the lines of a function using the supplied words as identifiers"""
+    name, a, b, x = next(words), next(words), next(words), next(words)
+    python = language == "py"
+    lines = [
+        "def %s(%s, %s):" % (name, a, b)
+        if python
+        else "int %s(int %s, int %s) {" % (name, a, b)
+    ]
+    if not python:
+        lines.append("    int %s = 0;" % x)
+    end = "" if python else ";"
+    for _ in range(body_lines):
+        kind = rng.random()
+        if kind < 0.15:
+            comment = "#" if python else "//"
+            lines.append("    %s %s %s %s" % (comment, next(words), next(words), next(words)))
+        elif kind < 0.45:
+            lines.append(
+                "    %s = %s(%s, %d)%s" % (x, next(words), a, rng.randint(0, 99), end)
+            )
+        elif kind < 0.75:
+            lines.append(
+                "    %s += %s %s %d%s" % (x, b, rng.choice(operators), rng.randint(1, 9), end)
+            )
+        else:
+            condition = "%s %s %s" % (a, rng.choice(comparisons), next(words))
+            lines.append(
+                ("    if %s: %s = %s" if python else "    if (%s) %s = %s;")
+                % (condition, x, next(words))
+            )
+    lines.append("    return %s%s" % (x, end))
+    if not python:
+        lines.append("}")
+    return lines
+
+
+def generate_file_lines(language, words, rng, lines_per_file):
+    lines = list()
+    class_name = None
+    if language in ("java", "cs"):
+        class_name = next(words).capitalize()
+        lines.append("public class %s {" % class_name)
+    while len(lines) < lines_per_file:
+        lines.extend(generate_function(language, words, rng, rng.randint(3, 20)))
+        lines.append("")
+    if class_name:
+        lines.append("}")
+    return lines
+
+
+def generate_corpus(
+    corpus_dir, files, lines_per_file, duplication_rate, vocabulary_size, seed
+):
+    """Generate a source tree with the given number of files in corpus_dir
+
+    A duplication_rate share of the files contain a block of about half of the
+    lines of another file of the same language, copied verbatim.
+    """
+    rng = random.Random(seed)
+    vocabulary, cumulative_weights = get_vocabulary(vocabulary_size, rng)
+
+    def word_stream():
+        while True:
+            yield from rng.choices(vocabulary, cum_weights=cumulative_weights, k=1024)
+
+    words = word_stream()
+    files_of_language = {language: list() for language in language_extensions}
+    files_per_directory = 100
+    for file_index in range(files):
+        language = language_extensions[file_index % len(language_extensions)]
+        lines = generate_file_lines(language, words, rng, lines_per_file)
+        copied_files = files_of_language[language]
+        if copied_files and rng.random() < duplication_rate:
+            with open(rng.choice(copied_files)) as copied_file:
+                copied_lines = copied_file.read().splitlines()
+            block_size = len(copied_lines) // 2
+            block_start = rng.randint(0, len(copied_lines) - block_size)
+            insert_at = rng.randint(0, len(lines))
+            lines[insert_at:insert_at] = copied_lines[block_start : block_start + block_size]
+        directory = os.path.join(corpus_dir, "dir%04d" % (file_index // files_per_directory))
+        os.makedirs(directory, exist_ok=True)
+        source_code_file = os.path.join(
+            directory, "file%06d.%s" % (file_index, language)
+        )
+        with open(source_code_file, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        copied_files.append(source_code_file)
+
+
+def get_corpus(corpora_dir, files, lines_per_file, duplication_rate, vocabulary_size, seed):
+    """Get the directory of a generated corpus, generating it if it doesn't exist yet"""
+    corpus_name = "corpus-%d-%d-%g-%d-%d" % (
+        files,
+        lines_per_file,
+        duplication_rate,
+        vocabulary_size,
+        seed,
+    )
+    corpus_dir = os.path.join(corpora_dir, corpus_name)
+    if not os.path.isdir(corpus_dir):
+        print("Generating %d files in %s" % (files, corpus_dir))
+        temporary_dir = corpus_dir + ".tmp"
+        generate_corpus(
+            temporary_dir, files, lines_per_file, duplication_rate, vocabulary_size, seed
+        )
+        os.replace(temporary_dir, corpus_dir)
+    return corpus_dir
+
+
+def get_directory_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory)
+        for name in names
+    )
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=repository_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_corpus(corpus_dir, tool_args):
+    """Run the tool on the corpus and get its wall time and profile"""
+    with tempfile.TemporaryDirectory() as profile_dir:
+        profile_path = os.path.join(profile_dir, "profile.json")
+        command = [sys.executable, "-W", "ignore", tool_path, "-d", corpus_dir]
+        command += ["--json", "true", "--profile", profile_path] + tool_args
+        start = time.perf_counter()
+        result = subprocess.run(
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+        )
+        wall_time = time.perf_counter() - start
+        # The profile is only written by runs that complete
+        if not os.path.isfile(profile_path):
+            raise RuntimeError("The tool failed on %s:\n%s" % (corpus_dir, result.stderr))
+        with open(profile_path) as profile_file:
+            profile = json.load(profile_file)
+    return wall_time, profile
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="End to end benchmark on synthetic source trees"
+    )
+    parser.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        default=default_scales,
+        help="The numbers of files of the source trees to benchmark.",
+    )
+    parser.add_argument(
+        "--lines-per-file", type=int, default=100, help="Lines of every file."
+    )
+    parser.add_argument(
+        "--duplication-rate",
+        type=float,
+        default=0.2,
+        help="The share of files that contain a block copied from another file.",
+    )
+    parser.add_argument(
+        "--vocabulary-size",
+        type=int,
+        default=5000,
+        help="The number of distinct identifiers in the source trees.",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="The seed of the source tree generator."
+    )
+    parser.add_argument(
+        "--corpora-dir",
+        default=os.path.join(tempfile.gettempdir(), "duplicate-code-detection-benchmark"),
+        help="Where the generated source trees are kept, to be reused by later runs.",
+    )
+    parser.add_argument(
+        "--results",
+        default="benchmark_results.jsonl",
+        help="The file the results are appended to, as one JSON object per run.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Times to run the tool on every tree."
+    )
+    parser.add_argument(
+        "tool_args",
+        nargs=argparse.REMAINDER,
+        help="Options for the tool, after --, e.g. -- --similarity-engine matrix. "
+        "By default: --tokenizer code --top-k 10, so the output of the larger "
+        "trees stays manageable.",
+    )
+    args = parser.parse_args()
+    tool_args = [arg for arg in args.tool_args if arg != "--"] or [
+        "--tokenizer",
+        "code",
+        "--top-k",
+        "10",
+    ]
+
+    os.makedirs(args.corpora_dir, exist_ok=True)
+    environment = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "gensim": duplicate_code_detection.gensim.__version__,
+        "numpy": duplicate_code_detection.numpy.__version__,
+    }
+    print(
+        "%8s %10s %10s %10s %14s   %s"
+        % ("Files", "Wall (s)", "Files/s", "MB/s", "Peak RSS (MB)", "Stages (s)")
+    )
+    for files in args.scales:
+        corpus_dir = get_corpus(
+            args.corpora_dir,
+            files,
+            args.lines_per_file,
+            args.duplication_rate,
+            args.vocabulary_size,
+            args.seed,
+        )
+        size_mb = get_directory_size(corpus_dir) / (1024 * 1024)
+        for _ in range(args.repeat):
+            wall_time, profile = benchmark_corpus(corpus_dir, tool_args)
+            peak_rss = profile["total"]["peak_rss"]
+            result = {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "environment": environment,
+                "corpus": {
+                    "files": files,
+                    "lines_per_file": args.lines_per_file,
+                    "duplication_rate": args.duplication_rate,
+                    "vocabulary_size": args.vocabulary_size,
+                    "seed": args.seed,
+                    "size_mb": size_mb,
+                },
+                "tool_args": tool_args,
+                "wall_time": wall_time,
+                "files_per_second": files / wall_time,
+                "mb_per_second": size_mb / wall_time,
+                "peak_rss": peak_rss,
+                "workers_peak_rss": profile["total"]["workers_peak_rss"],
+                "stages": profile["stages"],
+            }
+            with open(args.results, "a") as results_file:
+                results_file.write(json.dumps(result) + "\n")
+            stages = " ".join(
+                "%s=%.2f" % (stage["stage"].replace(" ", "-"), stage["wall_time"])
+                for stage in profile["stages"]
+            )
+            print(
+                "%8d %10.2f %10.1f %10.2f %14s   %s"
+                % (
+                    files,
+                    wall_time,
+                    files / wall_time,
+                    size_mb / wall_time,
+                    "-" if peak_rss is None else "%.1f" % peak_rss,
+                    stages,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
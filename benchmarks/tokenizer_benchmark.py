@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Measure the throughput of the tokenizers of the duplicate code detection tool.
+
+Every tokenizer is run over the same source code files, which are read into
+memory beforehand, so only the tokenization itself is timed.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import duplicate_code_detection  # noqa: E402
+
+
+def read_sources(directories, file_extensions):
+    sources = list()
+    for directory in directories:
+        for source_code_file in duplicate_code_detection.get_all_source_code_from_directory(
+            directory, file_extensions
+        ):
+            with open(source_code_file, "r", errors="surrogateescape") as f:
+                sources.append(f.read())
+    return sources
+
+
+def benchmark_tokenizer(sources, tokenizer, repeat):
+    """Get the best throughput (in MB/s) of the tokenizer and the number of tokens"""
+    size_mb = sum(len(source.encode("utf-8", "surrogateescape")) for source in sources)
+    size_mb /= 1024 * 1024
+    best_time = float("inf")
+    tokens_count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tokens_count = sum(
+            len(duplicate_code_detection.tokenize(source, tokenizer)) for source in sources
+        )
+        best_time = min(best_time, time.perf_counter() - start)
+    return size_mb / best_time, tokens_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokenizer throughput benchmark")
+    parser.add_argument(
+        "-d",
+        "--directories",
+        nargs="+",
+        required=True,
+        help="Directories with the source code to tokenize.",
+    )
+    parser.add_argument(
+        "--file-extensions",
+        nargs="+",
+        default=duplicate_code_detection.source_code_file_extensions,
+        help="File extensions of the source code files.",
+    )
+    parser.add_argument(
+        "--tokenizers",
+        nargs="+",
+        choices=duplicate_code_detection.tokenizers,
+        default=duplicate_code_detection.tokenizers,
+        help="The tokenizers to benchmark.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Times to run each tokenizer."
+    )
+    args = parser.parse_args()
+
+    sources = read_sources(args.directories, args.file_extensions)
+    size_mb = sum(len(source.encode("utf-8", "surrogateescape")) for source in sources)
+    size_mb /= 1024 * 1024
+    print("%d files, %.2f MB" % (len(sources), size_mb))
+    print("%-10s %12s %12s" % ("Tokenizer", "MB/s", "Tokens"))
+    for tokenizer in args.tokenizers:
+        throughput, tokens_count = benchmark_tokenizer(sources, tokenizer, args.repeat)
+        print("%-10s %12.2f %12d" % (tokenizer, throughput, tokens_count))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,15 +8,35 @@ import os
 import sys
 import argparse
 import gensim
-import ast
 import csv
-import astor
 import re
 import tempfile
 import json
+import copy
+import fnmatch
+import pickle
+import hashlib
+import functools
+import itertools
+import io
+import subprocess
+import zlib
+import concurrent.futures
+import socket
+import socketserver
+import signal
+import threading
+import time
+import numpy
+import scipy.sparse
 from enum import Enum
 from nltk.tokenize import word_tokenize
-from collections import OrderedDict
+from array import array
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
 
 source_code_file_extensions = ["h", "c", "cpp", "cc", "java", "py", "cs"]
 file_column_label = "File"
@@ -25,92 +45,3231 @@ similarity_column_label = "Similarity (%)"
 similarity_label_length = len(similarity_column_label)
 loc_label = "#LoC"
 similarity_label = "Similarity"
+similarity_before_label = "Similarity before"
+similarity_engines = ["gensim", "matrix", "fragments"]
+index_backends = ["auto", "memory", "disk"]
+top_k_methods = ["exact", "minhash"]
+# MinHash signatures are split in bands of rows for locality sensitive hashing.
+# Documents sharing all the rows of at least one band are compared with each other,
+# which mostly happens above a Jaccard similarity of their sets of tokens of
+# minhash_threshold. Tokens in more than minhash_max_df of the documents are left out.
+minhash_permutations = 128
+minhash_threshold = 0.15
+minhash_max_df = 0.1
+# Number of candidate pairs whose similarities are computed at once
+minhash_pairs_block_size = 16384
+tokenizers = ["nltk", "code"]
+code_token_pattern = re.compile(
+    r"""
+    [^\W\d]\w*                                       # identifiers and keywords
+    | \d[\w.]*                                       # numbers, including hex and floats
+    | <<=|>>=|\*\*=|//=|->|::|\.\.\.                 # operators of three characters and some of two
+    | [-+*/%&|^=!<>]=|&&|\|\||<<|>>|\+\+|--|\*\*|//  # the other operators of two characters
+    | [^\w\s]                                        # any other single character
+    """,
+    re.VERBOSE,
+)
+fragment_token_pattern = re.compile(r"\n|" + code_token_pattern.pattern, re.VERBOSE)
+python_file_extensions = ["py", "pyw", "pyi"]
+# Comments and string literals of Python source code. The leading lookahead lets
+# the regular expression engine skip quickly to the characters that can start them.
+python_lexeme_pattern = re.compile(
+    r"(?=[#'\"])(?:(?P<comment>#[^\n]*)|(?P<string>"
+    r"'''[^'\\]*(?:(?:\\.|'(?!''))[^'\\]*)*'''"
+    r'|"""[^"\\]*(?:(?:\\.|"(?!""))[^"\\]*)*"""'
+    r"|'[^'\\\n]*(?:\\.[^'\\\n]*)*'"
+    r'|"[^"\\\n]*(?:\\.[^"\\\n]*)*"))',
+    re.DOTALL,
+)
+python_string_prefix_pattern = re.compile(r"(?<!\w)[rRbBuUfF]{1,2}$")
+# What may follow a statement made only of a string, till the end of its line
+python_statement_end_pattern = re.compile(r"[ \t]*(?:#[^\n]*)?(?:\n|$)")
+c_style_file_extensions = [
+    "h", "hh", "hpp", "hxx", "c", "cc", "cpp", "cxx", "java", "cs"
+]
+c_style_comment_pattern = re.compile(
+    r'''
+    (?=[/"'@])                                                  # skip to what may start a match
+    (?:(?P<comment>//[^\n]*|/\*[^*]*(?:\*(?!/)[^*]*)*(?:\*/)?)  # line and block comments
+    | """[^"\\]*(?:(?:\\.|"(?!""))[^"\\]*)*(?:""")?             # Java text blocks
+    | @"[^"]*(?:""[^"]*)*"?                                     # C# verbatim strings
+    | "[^"\\\n]*(?:\\.[^"\\\n]*)*"?                             # string literals
+    | '[^'\\\n]*(?:\\.[^'\\\n]*)*'?)                            # character literals
+    ''',
+    re.VERBOSE | re.DOTALL,
+)
+# Number of rows of the similarity matrix computed at once by the matrix engine
+similarity_block_size = 1024
+default_socket_path = ".duplicate-code-detection.sock"
+# The fragments engine fingerprints every file by winnowing the hashes of its k-grams
+# of tokens. Fingerprints found in more places than the limit are boilerplate, which
+# is ignored so that the number of compared places stays near-linear.
+fragment_kgram_size = 16
+fragment_max_occurrences = 64
+fragment_hash_base = 1000003
+fragment_line_label = "Lines"
+fragment_other_line_label = "Other lines"
+fragments_label = "Fragments"
+
+
+class ReturnCode(Enum):
+    SUCCESS = 0
+    BAD_INPUT = 1
+    THRESHOLD_EXCEEDED = 2
+
+
+class CliColors:
+    HEADER = "\033[95m"
+    OKBLUE = "\033[94m"
+    OKGREEN = "\033[92m"
+    WARNING = "\033[93m"
+    FAIL = "\033[91m"
+    ENDC = "\033[0m"
+    BOLD = "\033[1m"
+    UNDERLINE = "\033[4m"
+
+
+def get_all_source_code_from_directory(
+    directory,
+    file_extensions,
+    ignore_directories=(),
+    ignore_patterns=(),
+    use_gitignore=False,
+):
+    """Get a list with all the source code files within the directory
+
+    Ignored directories, directories or files matching the ignore patterns and,
+    if enabled, paths ignored by .gitignore files are skipped while walking, so
+    the contents of ignored directories are never listed.
+    """
+    ignored_directories = {os.path.abspath(d) for d in ignore_directories}
+    source_code_files = list()
+    pending_directories = [(directory, list())]
+    while pending_directories:
+        dirpath, gitignore_rules = pending_directories.pop()
+        if use_gitignore:
+            gitignore_rules = gitignore_rules + read_gitignore_rules(dirpath)
+        try:
+            with os.scandir(dirpath) as entries:
+                entries = list(entries)
+        except OSError as err:
+            print(f"WARNING: Failed to list directory {dirpath}, reason: {str(err)}")
+            continue
+        for entry in entries:
+            is_directory = entry.is_dir()
+            relative_path = os.path.relpath(entry.path, directory).replace(os.sep, "/")
+            if is_ignored_by_patterns(entry.name, relative_path, ignore_patterns):
+                continue
+            if use_gitignore and is_ignored_by_gitignore(
+                entry.path, is_directory, gitignore_rules
+            ):
+                continue
+            if is_directory:
+                # Like os.walk, do not follow symbolic links to directories
+                if entry.is_symlink() or os.path.abspath(entry.path) in ignored_directories:
+                    continue
+                if use_gitignore and entry.name == ".git":
+                    continue
+                pending_directories.append((entry.path, gitignore_rules))
+                continue
+            _, file_extension = os.path.splitext(entry.name)
+            if file_extension[1:] in file_extensions:
+                source_code_files.append(os.path.join(dirpath, entry.name))
+
+    return source_code_files
+
+
+def is_ignored_by_patterns(name, relative_path, ignore_patterns):
+    """Check if a path matches any of the glob patterns
+
+    Patterns containing a slash are matched against the path relative to the
+    walked directory, the others against the name of the file or directory.
+    """
+    for pattern in ignore_patterns:
+        if "/" in pattern.rstrip("/"):
+            if fnmatch.fnmatchcase(relative_path, pattern.strip("/")):
+                return True
+        elif fnmatch.fnmatchcase(name, pattern.rstrip("/")):
+            return True
+    return False
+
+
+def gitignore_pattern_to_regex(pattern):
+    """Translate a .gitignore pattern to a regular expression matching paths
+    relative to the directory of the .gitignore file"""
+    # Patterns without a slash, other than a trailing one, match at any depth
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    regex = str()
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 1 :]:
+            end = pattern.index("]", i + 1)
+            regex += "[" + pattern[i + 1 : end].replace("!", "^", 1) + "]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    if not anchored:
+        regex = "(?:.*/)?" + regex
+    return re.compile(regex + "$")
+
+
+def read_gitignore_rules(directory):
+    """Get the rules of the .gitignore file in the directory, if there is one
+
+    Each rule is a tuple with the directory of the .gitignore file, the regular
+    expression of the pattern, whether the pattern is negated and whether it
+    only applies to directories.
+    """
+    rules = list()
+    try:
+        with open(os.path.join(directory, ".gitignore"), "r", errors="surrogateescape") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return rules
+    for line in lines:
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        if line.startswith("\\"):
+            line = line[1:]
+        directory_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            continue
+        rules.append((directory, gitignore_pattern_to_regex(line), negated, directory_only))
+    return rules
+
+
+def is_ignored_by_gitignore(path, is_directory, gitignore_rules):
+    """Check if a path is ignored, the last matching .gitignore rule wins"""
+    ignored = False
+    for base_directory, regex, negated, directory_only in gitignore_rules:
+        if directory_only and not is_directory:
+            continue
+        relative_path = os.path.relpath(path, base_directory).replace(os.sep, "/")
+        if regex.match(relative_path):
+            ignored = not negated
+    return ignored
+
+
+def git_ls_files(directory, *options):
+    """Get the entries listed by git ls-files for the directory, with paths
+    relative to it"""
+    output = subprocess.run(
+        ["git", "-C", directory, "ls-files", "-z"] + list(options),
+        capture_output=True,
+        check=True,
+    ).stdout
+    return [os.fsdecode(entry) for entry in output.split(b"\0") if entry]
+
+
+def get_git_repository_root(directory):
+    """Get the top level directory of the git repository the directory is in"""
+    output = subprocess.run(
+        ["git", "-C", directory, "rev-parse", "--show-toplevel"],
+        capture_output=True,
+        check=True,
+    ).stdout
+    return os.path.normpath(os.fsdecode(output.rstrip(b"\n")))
+
+
+def get_all_source_code_from_git(
+    directory, file_extensions, ignore_directories=(), ignore_patterns=()
+):
+    """Get the source code files tracked by git within the directory
+
+    The files are listed by git instead of walking the directory, so untracked
+    files, e.g. build output, are left out. Returns a dict mapping every file to
+    the id of its blob, or to None if its contents have to be read from disk,
+    because it was modified in the worktree, is a symbolic link or has merge
+    conflicts. Raises subprocess.CalledProcessError if the directory is not in
+    a git repository.
+    """
+    ignored_directories = {os.path.abspath(d) for d in ignore_directories}
+    modified_files = set(git_ls_files(directory, "--modified"))
+    ignored_prefixes = dict()
+
+    def is_ignored(relative_path):
+        parts = relative_path.split("/")
+        for depth in range(1, len(parts)):
+            prefix = "/".join(parts[:depth])
+            if prefix not in ignored_prefixes:
+                ignored_prefixes[prefix] = is_ignored_by_patterns(
+                    parts[depth - 1], prefix, ignore_patterns
+                ) or (
+                    os.path.abspath(os.path.join(directory, prefix))
+                    in ignored_directories
+                )
+            if ignored_prefixes[prefix]:
+                return True
+        return is_ignored_by_patterns(parts[-1], relative_path, ignore_patterns)
+
+    source_code_files = dict()
+    for entry in git_ls_files(directory, "--stage"):
+        entry_info, relative_path = entry.split("\t", 1)
+        mode, blob_id, stage = entry_info.split()
+        # Submodules are repositories of their own
+        if mode == "160000":
+            continue
+        _, file_extension = os.path.splitext(relative_path)
+        if file_extension[1:] not in file_extensions or is_ignored(relative_path):
+            continue
+        source_code_file = os.path.join(directory, relative_path)
+        if relative_path in modified_files or stage != "0" or mode == "120000":
+            # Modified files include the deleted ones
+            if not os.path.isfile(source_code_file):
+                continue
+            blob_id = None
+        source_code_files[source_code_file] = blob_id
+    return source_code_files
+
+
+def find_source_code_files(
+    directories,
+    files,
+    file_extensions,
+    ignore_directories=(),
+    ignore_files=(),
+    ignore_patterns=(),
+    use_gitignore=False,
+    git=False,
+    query_files=None,
+):
+    """Find the source code files to compare for similarities
+
+    The files are found in the directories, or are the supplied files if there are
+    no directories, and the queried files are added to them. Returns a tuple with
+    the sorted absolute paths of the files, the absolute paths of the queried
+    files (None if every file is queried, empty if no queried file is a source code
+    file), the ids of the git blobs of the files if git is set (see
+    get_all_source_code_from_git) and the top level directory of their repository.
+    Raises ValueError if the files cannot be found.
+    """
+    source_code_files = list()
+    blob_ids = None
+    git_repository_root = None
+    if directories:
+        for directory in directories:
+            if not os.path.isdir(directory):
+                raise ValueError(f"Path does not exist or is not a directory: {directory}")
+            if git:
+                try:
+                    directory_repository_root = get_git_repository_root(directory)
+                    directory_blob_ids = get_all_source_code_from_git(
+                        directory,
+                        file_extensions,
+                        ignore_directories,
+                        ignore_patterns or list(),
+                    )
+                except (OSError, subprocess.CalledProcessError) as err:
+                    reason = str(err)
+                    if getattr(err, "stderr", None):
+                        reason = err.stderr.decode(errors="replace").strip()
+                    raise ValueError(
+                        f"Failed to list the files tracked by git in {directory}, "
+                        f"reason: {reason}"
+                    ) from err
+                # The blobs are all read through the same git process
+                if git_repository_root not in (None, directory_repository_root):
+                    raise ValueError(
+                        "The directories must be in the same git repository with "
+                        f"--git: {directory}"
+                    )
+                git_repository_root = directory_repository_root
+                blob_ids = blob_ids or dict()
+                blob_ids.update(
+                    (os.path.abspath(f), blob_id)
+                    for f, blob_id in directory_blob_ids.items()
+                )
+                source_code_files += list(directory_blob_ids)
+                continue
+            source_code_files += get_all_source_code_from_directory(
+                directory,
+                file_extensions,
+                ignore_directories,
+                ignore_patterns or list(),
+                use_gitignore,
+            )
+    else:
+        if len(files) < 2:
+            raise ValueError("Too few files to compare, you need to supply at least 2")
+        for supplied_file in files:
+            if not os.path.isfile(supplied_file):
+                raise ValueError(f"Supplied file does not exist: {supplied_file}")
+        source_code_files = files
+
+    files_to_ignore = [os.path.normpath(f) for f in ignore_files or list()]
+    if query_files is not None:
+        # Only the queried source code files are compared against all the others,
+        # which are used to build the model. Queried files outside the supplied
+        # directories or files are added to the model as well.
+        query_files = [
+            os.path.normpath(f)
+            for f in query_files
+            if os.path.isfile(f) and os.path.splitext(f)[1][1:] in file_extensions
+        ]
+        query_files = set(query_files) - set(files_to_ignore)
+        if not query_files:
+            return (list(), query_files, blob_ids, git_repository_root)
+        source_code_files = source_code_files + list(query_files)
+        query_files = {os.path.abspath(f) for f in query_files}
+    source_code_files = [os.path.normpath(f) for f in source_code_files]
+    source_code_files = list(set(source_code_files) - set(files_to_ignore))
+    if len(source_code_files) < 2:
+        raise ValueError("Not enough source code files found")
+    # Sort the sources, so the results are sorted too and are reproducible
+    source_code_files.sort()
+    source_code_files = [os.path.abspath(f) for f in source_code_files]
+    return (source_code_files, query_files, blob_ids, git_repository_root)
+
+
+class GitBlobReader:
+    """Read the contents of blobs through a single git cat-file --batch process
+
+    Requests for all the blobs are written to the process by a thread while the
+    contents are read, so they are streamed through one pipe without waiting
+    for every blob in turn.
+    """
+
+    def __init__(self, directory):
+        self.process = subprocess.Popen(
+            ["git", "-C", directory, "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def write_requests(self, blob_ids):
+        try:
+            for blob_id in blob_ids:
+                self.process.stdin.write(blob_id.encode() + b"\n")
+            self.process.stdin.flush()
+        except OSError:  # The process was closed before reading all the blobs
+            pass
+
+    def read_blobs(self, blob_ids):
+        """Yield the contents of the blobs in order, decoded like open() would
+        decode a file, or None for the blobs missing from the repository"""
+        writer = threading.Thread(
+            target=self.write_requests, args=(blob_ids,), daemon=True
+        )
+        writer.start()
+        for _ in blob_ids:
+            header = self.process.stdout.readline().split()
+            if len(header) != 3:
+                # The process failed or the blob is missing
+                if not header:
+                    raise OSError("git cat-file exited unexpectedly")
+                yield None
+                continue
+            content = self.process.stdout.read(int(header[2]) + 1)[:-1]
+            with io.TextIOWrapper(io.BytesIO(content), errors="surrogateescape") as f:
+                yield f.read()
+        writer.join()
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process.wait()
+
+
+def conditional_print(text, machine_friendly_output):
+    if not machine_friendly_output:
+        print(text)
+
+
+def remove_comments_and_docstrings(
+    source_code: str, file_extension: str = "py"
+) -> str:
+    """Strip comments and docstrings from source code
+
+    The source code is scanned once, without being parsed, so this works in linear
+    time and never fails on source code that is not valid. Python comments and
+    docstrings are removed, as well as the comments of C-like languages, keeping
+    their line breaks so that lines keep their numbers. Source code of other
+    languages is returned unchanged.
+
+    :param source_code: Raw source code as a single string
+    :type source_code: str
+    :param file_extension: The extension of the source code file, without the dot
+    :type file_extension: str
+    :return: Stripped source code as a single string
+    :rtype: str
+    """
+    if file_extension in python_file_extensions:
+        return remove_python_comments_and_docstrings(source_code)
+    if file_extension in c_style_file_extensions:
+        return c_style_comment_pattern.sub(
+            lambda match: (
+                "\n" * match.group("comment").count("\n") or " "
+                if match.group("comment")
+                else match.group(0)
+            ),
+            source_code,
+        )
+    return source_code
+
+
+def remove_python_comments_and_docstrings(source_code):
+    """Strip comments and docstrings from Python source code
+
+    Any statement made only of a string is removed, which includes the docstrings
+    of modules, classes and functions. Brackets are counted to tell statements
+    apart from strings within expressions spanning multiple lines.
+    """
+    stripped_code = list()
+    position = 0
+    code_end = 0
+    brackets = 0
+    for match in python_lexeme_pattern.finditer(source_code):
+        start, end = match.span()
+        code = source_code[code_end:start]
+        code_end = end
+        brackets += code.count("(") + code.count("[") + code.count("{")
+        brackets -= code.count(")") + code.count("]") + code.count("}")
+        if match.lastgroup == "string":
+            prefix = python_string_prefix_pattern.search(source_code, start - 2, start)
+            if prefix:
+                start = prefix.start()
+            line_start = source_code.rfind("\n", 0, start) + 1
+            previous_line_end = line_start - 2
+            is_statement = (
+                brackets <= 0
+                and (line_start == start or source_code[line_start:start].isspace())
+                and (previous_line_end < 0 or source_code[previous_line_end] != "\\")
+                and python_statement_end_pattern.match(source_code, end)
+            )
+            if not is_statement:
+                continue
+        stripped_code.append(source_code[position:start])
+        stripped_code.append("\n" * source_code.count("\n", start, end))
+        position = end
+    stripped_code.append(source_code[position:])
+    return "".join(stripped_code)
+
+
+def tokenize(source_code, tokenizer="nltk"):
+    """Split source code into lowercase tokens
+
+    The "nltk" tokenizer is the NLTK word tokenizer, meant for natural language.
+    The "code" tokenizer is a lexer for C-like languages and Python that splits
+    identifiers, numbers and operators in a single pass of a regular expression.
+    """
+    if tokenizer == "code":
+        return code_token_pattern.findall(source_code.lower())
+    return [word.lower() for word in word_tokenize(source_code)]
+
+
+def get_hashed_vector(tokens, num_features):
+    """Get the (token ids, token counts) arrays of tokens, hashing every token into
+    one of num_features ids instead of looking it up in a dictionary"""
+    token_counts = dict()
+    for token in tokens:
+        token_counts[token] = token_counts.get(token, 0) + 1
+    feature_counts = dict()
+    for token, count in token_counts.items():
+        token_id = zlib.crc32(token.encode("utf-8", "surrogateescape")) % num_features
+        feature_counts[token_id] = feature_counts.get(token_id, 0) + count
+    token_ids = sorted(feature_counts)
+    return (array("I", token_ids), array("I", (feature_counts[i] for i in token_ids)))
+
+
+class CompactCorpus:
+    """A list of bag-of-words vectors, stored as arrays of token ids and counts
+
+    Keeps the memory footprint of each document to a few bytes per distinct token,
+    instead of a Python tuple per token, while still behaving like a gensim corpus.
+    """
+
+    def __init__(self):
+        self.token_ids = list()
+        self.token_counts = list()
+
+    def append(self, bow):
+        self.append_arrays(
+            array("I", (token_id for token_id, _ in bow)),
+            array("I", (count for _, count in bow)),
+        )
+
+    def append_arrays(self, token_ids, token_counts):
+        self.token_ids.append(token_ids)
+        self.token_counts.append(token_counts)
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def __getitem__(self, index):
+        return list(zip(self.token_ids[index], self.token_counts[index]))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def get_content_key(settings, content):
+    """Hash the contents of a file together with the settings used to process it"""
+    content_hash = hashlib.sha256(settings.encode())
+    content_hash.update(content.encode("utf-8", "surrogateescape"))
+    return content_hash.hexdigest()
+
+
+def get_blob_key(settings, blob_id):
+    """Hash the id of a git blob, which already identifies its contents, together
+    with the settings used to process it"""
+    return hashlib.sha256(("%s|blob %s" % (settings, blob_id)).encode()).hexdigest()
+
+
+class CorpusCache:
+    """Persistent cache of the bag-of-words vectors of the analyzed files
+
+    The vectors and the line counts of the files are stored keyed by a hash of
+    the file contents, or of the id of their git blob, and of the settings that
+    affect the vectorization, together with the dictionary that maps their token
+    ids to tokens, so that unchanged files do not have to be processed again in
+    consecutive runs.
+    """
+
+    format_version = 4
+    file_name = "corpus.pickle"
+
+    def __init__(self, cache_dir, settings, hashed=False):
+        """If the vectors are hashed (see get_hashed_vector), the dictionary is
+        left empty"""
+        self.cache_dir = cache_dir
+        self.settings = "%d|%s" % (self.format_version, settings)
+        self.dictionary = gensim.corpora.Dictionary()
+        self.vectors = dict()
+        self.used_vectors = dict()
+        cache_path = os.path.join(cache_dir, self.file_name)
+        if os.path.isfile(cache_path):
+            try:
+                with open(cache_path, "rb") as cache_file:
+                    dictionary, vectors = pickle.load(cache_file)
+                if not hashed:
+                    self.dictionary = dictionary
+                self.vectors = vectors
+            except Exception as err:
+                print(f"WARNING: Ignoring unreadable cache in {cache_dir}, reason: {str(err)}")
+
+    def key(self, content):
+        return get_content_key(self.settings, content)
+
+    def get(self, key):
+        """Get the (token ids, token counts, line count) stored for the key, if any"""
+        vector = self.vectors.get(key)
+        if vector is not None:
+            self.used_vectors[key] = vector
+        return vector
+
+    def put(self, key, token_ids, token_counts, loc_count):
+        self.used_vectors[key] = (token_ids, token_counts, loc_count)
+
+    def save(self):
+        """Store the dictionary and the vectors used in this run in a single file
+
+        Vectors of files that were not analyzed in this run are dropped. If most of
+        the dictionary is no longer referenced by the stored vectors, it is compacted
+        and the vectors are remapped to the new token ids.
+        """
+        dictionary = self.dictionary
+        vectors = self.used_vectors
+        used_token_ids = set()
+        for token_ids, _, _ in vectors.values():
+            used_token_ids.update(token_ids)
+        if len(used_token_ids) < len(dictionary) // 2:
+            # Compact a copy, since the token ids of this run must remain valid
+            dictionary = copy.deepcopy(dictionary)
+            old_id2token = {i: t for t, i in dictionary.token2id.items()}
+            dictionary.filter_tokens(good_ids=used_token_ids)
+            dictionary.compactify()
+            old_to_new_id = {
+                old_id: dictionary.token2id[old_id2token[old_id]]
+                for old_id in used_token_ids
+            }
+            vectors = {
+                key: (
+                    array("I", (old_to_new_id[i] for i in token_ids)),
+                    token_counts,
+                    loc_count,
+                )
+                for key, (token_ids, token_counts, loc_count) in vectors.items()
+            }
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # The dictionary and the vectors are written to a temporary file of this
+        # run and replace the cache at once, so neither an interrupted run nor runs
+        # saving the cache at the same time can leave a dictionary that does not
+        # match the vectors
+        cache_path = os.path.join(self.cache_dir, self.file_name)
+        temporary_path = "%s.%d.tmp" % (cache_path, os.getpid())
+        with open(temporary_path, "wb") as cache_file:
+            pickle.dump((dictionary, vectors), cache_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, cache_path)
+
+
+# Cache keys of the already processed files, set in each preprocessing worker process
+cached_content_keys = frozenset()
+# Time spent in each step of preprocessing files, accumulated by every process
+preprocessing_times = dict()
+
+
+def init_preprocessing_worker(content_keys):
+    global cached_content_keys
+    cached_content_keys = content_keys
+
+
+def add_preprocessing_time(step, start_time):
+    """Add the time since start_time to the step and return the current time"""
+    now = time.perf_counter()
+    preprocessing_times[step] = preprocessing_times.get(step, 0.0) + now - start_time
+    return now
+
+
+def get_preprocessing_stats(function, source_code_file):
+    """Preprocess a file, also returning the time spent in each preprocessing step,
+    the CPU time it took and the peak memory of the process"""
+    preprocessing_times.clear()
+    cpu_start = time.process_time()
+    result = function(source_code_file)
+    cpu_time = time.process_time() - cpu_start
+    return (result, dict(preprocessing_times), cpu_time, get_peak_rss())
+
+
+def preprocess_source_file(
+    source_code_file, only_code, cache_settings=None, tokenizer="nltk", num_features=0
+):
+    """Read and tokenize a source code file
+
+    Returns a tuple with the cache key of the file contents (if caching is enabled),
+    the tokens of the file (or None if the file is already cached), the number of
+    lines of the file and an error message (or None if the file was processed
+    successfully). If num_features is set, the tokens are hashed into the
+    (token ids, token counts) arrays of the file, see get_hashed_vector.
+    """
+    try:
+        start_time = time.perf_counter()
+        # read file but also recover from encoding errors in source files
+        with open(source_code_file, "r", errors="surrogateescape") as f:
+            content = f.read()
+        loc_count = count_lines(content)
+        start_time = add_preprocessing_time("read", start_time)
+        cache_key = None
+        if cache_settings is not None:
+            cache_key = get_content_key(cache_settings, content)
+            start_time = add_preprocessing_time("cache lookup", start_time)
+            if cache_key in cached_content_keys:
+                return (cache_key, None, loc_count, None)
+        tokens = tokenize_source_code(
+            source_code_file, content, only_code, tokenizer, start_time, num_features
+        )
+        return (cache_key, tokens, loc_count, None)
+    except Exception as err:
+        return (None, None, -1, str(err))
+
+
+def tokenize_source_code(
+    source_code_file, content, only_code, tokenizer, start_time, num_features=0
+):
+    """Tokenize the contents of a file, timing the steps from start_time, and hash
+    the tokens if num_features is set"""
+    if only_code:
+        _, file_extension = os.path.splitext(source_code_file)
+        content = remove_comments_and_docstrings(content, file_extension[1:])
+        start_time = add_preprocessing_time("strip comments", start_time)
+    tokens = tokenize(content, tokenizer)
+    start_time = add_preprocessing_time("tokenize", start_time)
+    if num_features:
+        tokens = get_hashed_vector(tokens, num_features)
+        add_preprocessing_time("hash tokens", start_time)
+    return tokens
+
+
+def preprocess_git_file(
+    git_file, only_code, cache_settings=None, tokenizer="nltk", num_features=0
+):
+    """Tokenize a file tracked by git, given as a tuple with its path, the cache
+    key of its blob and the contents of the blob
+
+    Files without contents are read from disk by preprocess_source_file.
+    Returns the same tuple as preprocess_source_file.
+    """
+    source_code_file, cache_key, content = git_file
+    if content is None:
+        return preprocess_source_file(
+            source_code_file, only_code, cache_settings, tokenizer, num_features
+        )
+    try:
+        tokens = tokenize_source_code(
+            source_code_file,
+            content,
+            only_code,
+            tokenizer,
+            time.perf_counter(),
+            num_features,
+        )
+        return (cache_key, tokens, count_lines(content), None)
+    except Exception as err:
+        return (None, None, -1, str(err))
+
+
+def preprocess_source_files(
+    source_code_files,
+    only_code,
+    cache=None,
+    jobs=1,
+    tokenizer="nltk",
+    stats=None,
+    num_features=0,
+):
+    """Preprocess the source code files, using multiple processes if jobs > 1
+
+    The results are returned in the same order as the supplied files, with the
+    tokens hashed if num_features is set. If stats is given, the preprocessing
+    statistics are gathered in it, see map_timed_source_files.
+    """
+    cache_settings = cache.settings if cache else None
+    content_keys = frozenset(cache.vectors) if cache else frozenset()
+    preprocess = functools.partial(
+        preprocess_source_file,
+        only_code=only_code,
+        cache_settings=cache_settings,
+        tokenizer=tokenizer,
+        num_features=num_features,
+    )
+    if stats is not None:
+        return map_timed_source_files(
+            preprocess,
+            source_code_files,
+            jobs,
+            stats,
+            init_preprocessing_worker,
+            (content_keys,),
+        )
+    return map_source_files(
+        preprocess, source_code_files, jobs, init_preprocessing_worker, (content_keys,)
+    )
+
+
+def preprocess_git_files(
+    source_code_files,
+    blob_ids,
+    blob_reader,
+    only_code,
+    cache=None,
+    jobs=1,
+    tokenizer="nltk",
+    stats=None,
+    num_features=0,
+):
+    """Preprocess files tracked by git like preprocess_source_files
+
+    blob_ids maps the files to the ids of their blobs (see
+    get_all_source_code_from_git), whose contents are read through the
+    GitBlobReader by this process as the workers need them and only tokenized by
+    the workers, so only a few batches of contents are held in memory. The blobs
+    are keyed in the cache by their ids, so the cached ones are not even read,
+    and their results have no tokens and a line count of -1. Files without a
+    blob id are read from disk.
+    """
+    cache_settings = cache.settings if cache else None
+    content_keys = frozenset(cache.vectors) if cache else frozenset()
+    cache_keys = [
+        get_blob_key(cache_settings, blob_ids[f]) if cache and blob_ids.get(f) else None
+        for f in source_code_files
+    ]
+    uncached_files = [
+        (f, cache_key)
+        for f, cache_key in zip(source_code_files, cache_keys)
+        if cache_key not in content_keys
+    ]
+    contents = blob_reader.read_blobs(
+        [blob_ids[f] for f, _ in uncached_files if blob_ids.get(f)]
+    )
+
+    def read_git_files():
+        for f, cache_key in uncached_files:
+            content = None
+            if blob_ids.get(f):
+                start_time = time.perf_counter()
+                content = next(contents)
+                if stats is not None:
+                    steps = stats.setdefault("steps", dict())
+                    read_time = time.perf_counter() - start_time
+                    steps["read"] = steps.get("read", 0.0) + read_time
+            yield (f, cache_key, content)
+        # Drain the reader, so it is ready for further reads
+        for _ in contents:
+            pass
+
+    preprocess = functools.partial(
+        preprocess_git_file,
+        only_code=only_code,
+        cache_settings=cache_settings,
+        tokenizer=tokenizer,
+        num_features=num_features,
+    )
+    if stats is not None:
+        results = map_timed_source_files(
+            preprocess,
+            read_git_files(),
+            jobs,
+            stats,
+            init_preprocessing_worker,
+            (content_keys,),
+            len(uncached_files),
+        )
+    else:
+        results = map_source_files(
+            preprocess,
+            read_git_files(),
+            jobs,
+            init_preprocessing_worker,
+            (content_keys,),
+            len(uncached_files),
+        )
+    for cache_key in cache_keys:
+        if cache_key is not None and cache_key in content_keys:
+            yield (cache_key, None, -1, None)
+        else:
+            yield next(results)
+
+
+def map_source_files(
+    function, source_code_files, jobs, initializer=None, initargs=(), num_files=None
+):
+    """Apply the function to every file, using multiple processes if jobs > 1
+
+    The results are returned in the same order as the supplied files. The files
+    may be any iterable, which is consumed in batches as the results are read,
+    in which case num_files must be its length.
+    """
+    if jobs <= 1:
+        if initializer:
+            initializer(*initargs)
+        return map(function, source_code_files)
+
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=initializer, initargs=initargs
+    )
+    if num_files is None:
+        num_files = len(source_code_files)
+    # Send the files in chunks to limit the inter-process communication overhead
+    chunksize = max(1, min(64, num_files // (jobs * 4)))
+    batch_size = chunksize * jobs * 4
+
+    def results():
+        with executor:
+            files = iter(source_code_files)
+            batch_results = iter(())
+            # Submit the next batch before collecting the results of the previous
+            # one, so the workers are kept busy
+            while True:
+                batch = list(itertools.islice(files, batch_size))
+                previous_results = batch_results
+                batch_results = executor.map(function, batch, chunksize=chunksize)
+                yield from previous_results
+                if not batch:
+                    break
+
+    return results()
+
+
+def map_timed_source_files(
+    function,
+    source_code_files,
+    jobs,
+    stats,
+    initializer=None,
+    initargs=(),
+    num_files=None,
+):
+    """Apply the preprocessing function to every file like map_source_files
+
+    The time spent in each preprocessing step and the CPU time are added up in the
+    "steps" and "cpu_time" entries of the stats dict, and the largest peak memory
+    of the processes is kept in its "peak_rss" entry.
+    """
+    stats.setdefault("steps", dict())
+    stats.setdefault("cpu_time", 0.0)
+    stats.setdefault("peak_rss", None)
+    timed_function = functools.partial(get_preprocessing_stats, function)
+    for result, times, cpu_time, peak_rss in map_source_files(
+        timed_function, source_code_files, jobs, initializer, initargs, num_files
+    ):
+        for step, step_time in times.items():
+            stats["steps"][step] = stats["steps"].get(step, 0.0) + step_time
+        stats["cpu_time"] += cpu_time
+        if peak_rss is not None:
+            stats["peak_rss"] = max(stats["peak_rss"] or 0, peak_rss)
+        yield result
+
+
+def count_lines(content):
+    """Count the lines of the contents of a file, the same way readlines() would"""
+    if not content:
+        return 0
+    return content.count("\n") + (0 if content.endswith("\n") else 1)
+
+
+def get_loc_to_print(loc_count):
+    loc_to_print = str(loc_count) if loc_count >= 0 else ""
+    return loc_to_print
+
+
+def hash_source_file(source_code_file, normalize=False):
+    """Hash the contents of a file, optionally ignoring comments and whitespace
+
+    Returns a tuple with the hash, the number of lines of the file and an error
+    message (or None if the file was read successfully).
+    """
+    try:
+        with open(source_code_file, "r", errors="surrogateescape") as f:
+            content = f.read()
+        loc_count = count_lines(content)
+        if normalize:
+            _, file_extension = os.path.splitext(source_code_file)
+            content = remove_comments_and_docstrings(content, file_extension[1:])
+            content = " ".join(content.split())
+        content_hash = hashlib.sha256(content.encode("utf-8", "surrogateescape"))
+        return (content_hash.hexdigest(), loc_count, None)
+    except Exception as err:
+        return (None, -1, str(err))
+
+
+def find_duplicate_files(source_code_files, jobs=1, preferred_files=()):
+    """Group the files that are identical, apart from whitespace and comments
+
+    The files are grouped by the hash of their contents first, so that only one
+    file of every group of exact copies has to be normalized and hashed again.
+    Files that cannot be read are left out. Returns a dict mapping the first file
+    of every group, or its first preferred file if any, to the other files of the
+    group, and a dict with the number of lines of these other files.
+    """
+    exact_copies = dict()
+    loc_counts = dict()
+    for source_code_file, (content_hash, loc_count, error) in zip(
+        source_code_files, map_source_files(hash_source_file, source_code_files, jobs)
+    ):
+        if error is None:
+            exact_copies.setdefault(content_hash, list()).append(source_code_file)
+            loc_counts[source_code_file] = loc_count
+
+    copies = list(exact_copies.values())
+    first_copies = [file_copies[0] for file_copies in copies]
+    hash_normalized = functools.partial(hash_source_file, normalize=True)
+    groups = dict()
+    for file_copies, (content_hash, _, error) in zip(
+        copies, map_source_files(hash_normalized, first_copies, jobs)
+    ):
+        if error is None:
+            groups.setdefault(content_hash, list()).extend(file_copies)
+
+    preferred_files = set(preferred_files)
+    duplicate_files = dict()
+    for group in groups.values():
+        if len(group) < 2:
+            continue
+        group.sort()
+        representative = next((f for f in group if f in preferred_files), group[0])
+        duplicate_files[representative] = [f for f in group if f != representative]
+    duplicate_loc_counts = {
+        f: loc_counts[f] for duplicates in duplicate_files.values() for f in duplicates
+    }
+    return (duplicate_files, duplicate_loc_counts)
+
+
+def select_index_backend(corpus, memory_limit_mb):
+    """Choose the in-memory index if the estimated size of the index fits within
+    the memory limit, otherwise the on-disk one"""
+    num_nnz = sum(len(token_ids) for token_ids in corpus.token_ids)
+    # A sparse index stores a float32 value and an int32 column per non-zero entry
+    estimated_index_size = num_nnz * 8 + (len(corpus) + 1) * 4
+    if estimated_index_size <= memory_limit_mb * 1024 * 1024:
+        return "memory"
+    return "disk"
+
+
+def gensim_similarity_rows(
+    tf_idf_corpus, num_features, query_indices=None, index_backend="disk"
+):
+    """Yield the similarities of every queried document (all of them by default)
+    against the whole corpus, one gensim index query per document
+
+    The "memory" backend keeps the whole index in memory. The "disk" backend stores
+    the index shards in a private temporary directory, from where they are memory
+    mapped, and removes it once all the documents have been queried. Rounding
+    errors can make identical documents more similar than 1, so the similarities
+    are capped at 1.
+    """
+    if query_indices is None:
+        query_indices = range(len(tf_idf_corpus))
+    if index_backend == "memory":
+        sims = gensim.similarities.SparseMatrixSimilarity(
+            tf_idf_corpus, num_features=num_features
+        )
+        for query_index in query_indices:
+            yield numpy.minimum(sims[tf_idf_corpus[query_index]], 1.0)
+        return
+
+    with tempfile.TemporaryDirectory(prefix="duplicate-code-detection-") as index_dir:
+        sims = gensim.similarities.Similarity(
+            os.path.join(index_dir, "shard"), tf_idf_corpus, num_features=num_features
+        )
+        for query_index in query_indices:
+            yield numpy.minimum(sims[tf_idf_corpus[query_index]], 1.0)
+
+
+def get_tf_idf_matrix(tf_idf_corpus, num_features):
+    """Get the documents as the unit-length rows of a sparse matrix"""
+    tf_idf_matrix = gensim.matutils.corpus2csc(
+        (gensim.matutils.unitvec(doc) for doc in tf_idf_corpus),
+        num_terms=num_features,
+        num_docs=len(tf_idf_corpus),
+        dtype=numpy.float32,
+    )
+    return tf_idf_matrix.T.tocsr()
+
+
+def matrix_similarity_rows(
+    tf_idf_corpus, num_features, query_indices=None, block_size=similarity_block_size
+):
+    """Yield the similarities of every queried document (all of them by default)
+    against the whole corpus
+
+    All the documents are placed in a single sparse matrix with unit-length rows,
+    so the cosine similarities are obtained by multiplying the matrix with its
+    transpose. The product is computed in blocks of rows to keep memory bounded.
+    The similarities are capped at 1, which rounding errors can exceed.
+    """
+    tf_idf_matrix_rows = get_tf_idf_matrix(tf_idf_corpus, num_features)
+    tf_idf_matrix = tf_idf_matrix_rows.T.tocsc()
+    if query_indices is None:
+        query_indices = range(tf_idf_matrix_rows.shape[0])
+    for block_start in range(0, len(query_indices), block_size):
+        block_indices = query_indices[block_start : block_start + block_size]
+        block = tf_idf_matrix_rows[block_indices]
+        yield from numpy.minimum((block @ tf_idf_matrix).toarray(), 1.0)
+
+
+def top_k_similarity_rows(similarity_rows, top_k, row_indices):
+    """Keep only the top_k most similar documents of every row of similarities
+
+    Yields lists of (document index, similarity), sorted by descending similarity.
+    The document a row belongs to, given by row_indices, is not included.
+    """
+    for row_index, similarities in zip(row_indices, similarity_rows):
+        similarities = numpy.array(similarities, dtype=numpy.float32)
+        similarities[row_index] = -numpy.inf
+        k = min(top_k, len(similarities) - 1)
+        if k <= 0:
+            yield list()
+            continue
+        top_indices = numpy.argpartition(-similarities, k - 1)[:k]
+        top_indices = top_indices[numpy.argsort(-similarities[top_indices], kind="stable")]
+        yield [(int(i), similarities[i]) for i in top_indices]
+
+
+def duplicate_similarity_rows(
+    similarity_rows, row_indices, duplicate_indices, duplicate_rows, top_k=0
+):
+    """Add the collapsed duplicates of the documents to rows of similarities
+
+    Every duplicate is as similar to the other documents as the document it was
+    collapsed to, given by duplicate_indices, and identical to it. duplicate_rows
+    lists the (duplicate index, document index) of the duplicates that need a row
+    of their own, which are yielded after all the other rows.
+    """
+    representative_rows = {i: None for _, i in duplicate_rows}
+    for row_index, similarities in zip(row_indices, similarity_rows):
+        row = [(i, 1.0) for i in duplicate_indices.get(row_index, ())]
+        for i, similarity in similarities:
+            row.append((i, similarity))
+            if i != row_index:
+                row.extend((d, similarity) for d in duplicate_indices.get(i, ()))
+        if row_index in representative_rows:
+            representative_rows[row_index] = row
+        yield row[:top_k] if top_k else row
+    for duplicate_index, row_index in duplicate_rows:
+        row = [(row_index, 1.0)]
+        row.extend(
+            (i, similarity)
+            for i, similarity in representative_rows[row_index]
+            if i not in (duplicate_index, row_index)
+        )
+        yield row[:top_k] if top_k else row
+
+
+def get_minhash_bands(num_permutations, threshold):
+    """Split num_permutations MinHash rows into (bands, rows per band)
+
+    Documents whose sets of tokens have a Jaccard similarity s share a band with
+    a probability of 1 - (1 - s^rows)^bands, which rises sharply around
+    (1 / bands)^(1 / rows). The split is the one placing that point closest to
+    the threshold.
+    """
+    splits = [
+        (num_permutations // rows, rows)
+        for rows in range(1, num_permutations + 1)
+        if num_permutations % rows == 0
+    ]
+    return min(
+        splits, key=lambda split: abs((1 / split[0]) ** (1 / split[1]) - threshold)
+    )
+
+
+def get_minhash_signatures(corpus, num_permutations, max_df=minhash_max_df):
+    """Get the MinHash signature of the set of tokens of every document
+
+    Tokens found in more than a max_df share of the documents, e.g. keywords, are
+    left out, since they make unrelated documents look alike. Documents made only
+    of such tokens keep all their tokens.
+    """
+    mersenne_prime = (1 << 31) - 1
+    random_state = numpy.random.RandomState(0)
+    a = random_state.randint(1, mersenne_prime, size=(num_permutations, 1), dtype=numpy.uint64)
+    b = random_state.randint(0, mersenne_prime, size=(num_permutations, 1), dtype=numpy.uint64)
+    signatures = numpy.full((len(corpus), num_permutations), mersenne_prime, dtype=numpy.uint64)
+    documents_token_ids = [
+        numpy.frombuffer(token_ids, dtype=numpy.uint32) for token_ids in corpus.token_ids
+    ]
+    document_frequencies = numpy.bincount(
+        numpy.concatenate(documents_token_ids + [numpy.zeros(0, dtype=numpy.uint32)])
+    )
+    frequent_tokens = document_frequencies > max_df * len(corpus)
+    for doc_index, token_ids in enumerate(documents_token_ids):
+        rare_token_ids = token_ids[~frequent_tokens[token_ids]]
+        if len(rare_token_ids):
+            token_ids = rare_token_ids
+        if not len(token_ids):
+            continue
+        token_ids = token_ids.astype(numpy.uint64)
+        signatures[doc_index] = ((a * token_ids + b) % mersenne_prime).min(axis=1)
+    return signatures
+
+
+def get_minhash_buckets(signatures, bands, band_rows):
+    """Get a sparse matrix with a row for every document and a column for every
+    bucket shared by several documents, with a 1 where a document is in a bucket
+
+    Documents are in the same bucket of a band if their signatures are equal in
+    all the rows of that band.
+    """
+    doc_indices = list()
+    bucket_indices = list()
+    num_buckets = 0
+    for band in range(bands):
+        _, band_buckets = numpy.unique(
+            signatures[:, band * band_rows : (band + 1) * band_rows],
+            axis=0,
+            return_inverse=True,
+        )
+        band_buckets = band_buckets.ravel()
+        # Buckets of a single document do not make any candidate
+        bucket_sizes = numpy.bincount(band_buckets)
+        shared_buckets = numpy.flatnonzero(bucket_sizes > 1)
+        in_shared_bucket = bucket_sizes[band_buckets] > 1
+        bucket_numbers = numpy.zeros(len(bucket_sizes), dtype=numpy.int64)
+        bucket_numbers[shared_buckets] = numpy.arange(len(shared_buckets)) + num_buckets
+        doc_indices.append(numpy.flatnonzero(in_shared_bucket))
+        bucket_indices.append(bucket_numbers[band_buckets[in_shared_bucket]])
+        num_buckets += len(shared_buckets)
+    doc_indices = numpy.concatenate(doc_indices)
+    return scipy.sparse.csr_matrix(
+        (
+            numpy.ones(len(doc_indices), dtype=numpy.float32),
+            (doc_indices, numpy.concatenate(bucket_indices)),
+        ),
+        shape=(len(signatures), num_buckets),
+    )
+
+
+def minhash_similarity_rows(
+    tf_idf_corpus,
+    num_features,
+    corpus,
+    top_k,
+    query_indices=None,
+    num_permutations=minhash_permutations,
+    threshold=minhash_threshold,
+    block_size=similarity_block_size,
+):
+    """Approximately find the top_k most similar documents of every queried document
+
+    Documents are hashed into buckets by the bands of their MinHash signatures
+    (locality sensitive hashing), so documents sharing many tokens end up in the
+    same buckets. Only documents sharing a bucket with the queried one are compared
+    using the cosine similarity of their TF-IDF vectors, so the full similarity
+    matrix is never computed. The candidates of a block of queried documents are
+    found at once and compared in blocks of pairs to keep memory bounded. Yields
+    lists of (document index, similarity), sorted by descending similarity.
+    """
+    tf_idf_matrix_rows = get_tf_idf_matrix(tf_idf_corpus, num_features)
+    bands, band_rows = get_minhash_bands(num_permutations, threshold)
+    buckets = get_minhash_buckets(
+        get_minhash_signatures(corpus, bands * band_rows), bands, band_rows
+    )
+    buckets_transposed = buckets.T.tocsc()
+
+    if query_indices is None:
+        query_indices = range(len(corpus))
+    for block_start in range(0, len(query_indices), block_size):
+        block_indices = numpy.asarray(
+            query_indices[block_start : block_start + block_size], dtype=numpy.int64
+        )
+        # The pairs of documents sharing at least one bucket
+        candidates = (buckets[block_indices] @ buckets_transposed).tocoo()
+        rows, candidate_indices = candidates.row, candidates.col
+        not_queried = candidate_indices != block_indices[rows]
+        rows, candidate_indices = rows[not_queried], candidate_indices[not_queried]
+        similarities = numpy.empty(len(rows), dtype=numpy.float32)
+        for pairs_start in range(0, len(rows), minhash_pairs_block_size):
+            pairs = slice(pairs_start, pairs_start + minhash_pairs_block_size)
+            similarities[pairs] = numpy.asarray(
+                tf_idf_matrix_rows[block_indices[rows[pairs]]]
+                .multiply(tf_idf_matrix_rows[candidate_indices[pairs]])
+                .sum(axis=1)
+            ).ravel()
+        similarities = numpy.minimum(similarities, 1.0)
+        # Sort by row, then by descending similarity and by document index
+        order = numpy.lexsort((candidate_indices, -similarities, rows))
+        row_starts = numpy.searchsorted(
+            rows[order], numpy.arange(len(block_indices) + 1)
+        )
+        for row in range(len(block_indices)):
+            row_order = order[row_starts[row] : row_starts[row + 1]][:top_k]
+            yield [
+                (int(i), similarity)
+                for i, similarity in zip(
+                    candidate_indices[row_order], similarities[row_order]
+                )
+            ]
+
+
+def get_fragment_tokens(source_code):
+    """Get the hashes and the line numbers of the tokens of source code
+
+    Tokens are lowercased and numbers are replaced by a placeholder, so fragments
+    that only differ in those are still found.
+    """
+    # Line breaks are matched as tokens too, to count the lines in the same pass
+    tokens = fragment_token_pattern.findall(source_code.lower())
+    distinct_tokens = {"\n": 0}
+    token_indices = numpy.array(
+        [distinct_tokens.setdefault(token, len(distinct_tokens)) for token in tokens],
+        dtype=numpy.int64,
+    )
+    # Hash every distinct token only once
+    distinct_token_hashes = numpy.array(
+        [
+            zlib.crc32(
+                ("0" if token[0].isdigit() else token).encode("utf-8", "surrogateescape")
+            )
+            for token in distinct_tokens
+        ],
+        dtype=numpy.uint32,
+    )
+    is_line_break = token_indices == 0
+    token_lines = (numpy.cumsum(is_line_break) + 1)[~is_line_break]
+    return (
+        distinct_token_hashes[token_indices[~is_line_break]],
+        token_lines.astype(numpy.uint32),
+    )
+
+
+def preprocess_fragment_source_file(source_code_file, only_code):
+    """Read a source code file and get the hashes and the line numbers of its tokens
+
+    Returns a tuple with the token hashes, their line numbers, the number of lines
+    of the file and an error message (or None if the file was processed successfully).
+    """
+    try:
+        start_time = time.perf_counter()
+        with open(source_code_file, "r", errors="surrogateescape") as f:
+            content = f.read()
+        loc_count = count_lines(content)
+        start_time = add_preprocessing_time("read", start_time)
+        if only_code:
+            _, file_extension = os.path.splitext(source_code_file)
+            content = remove_comments_and_docstrings(content, file_extension[1:])
+            start_time = add_preprocessing_time("strip comments", start_time)
+        token_hashes, token_lines = get_fragment_tokens(content)
+        add_preprocessing_time("tokenize", start_time)
+        return (token_hashes, token_lines, loc_count, None)
+    except Exception as err:
+        return (None, None, -1, str(err))
+
+
+def get_fingerprints(token_hashes, kgram_size, window_size):
+    """Select the fingerprints of a file by winnowing the hashes of its k-grams
+
+    The smallest hash of every window of consecutive k-grams is selected, so every
+    fragment of at least window_size + kgram_size - 1 tokens that two files share
+    has a fingerprint in common. Returns the selected hashes and their positions.
+    """
+    tokens = numpy.asarray(token_hashes, dtype=numpy.uint64)
+    num_kgrams = len(tokens) - kgram_size + 1
+    if num_kgrams <= 0:
+        return (numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=numpy.int64))
+    # Polynomial hash of every k-gram, computed modulo 2^64 for all k-grams at once
+    kgram_hashes = numpy.zeros(num_kgrams, dtype=numpy.uint64)
+    for i in range(kgram_size):
+        kgram_hashes = kgram_hashes * numpy.uint64(fragment_hash_base) + tokens[
+            i : i + num_kgrams
+        ]
+    # Mix the bits, so the smallest hashes do not depend mostly on the first tokens
+    kgram_hashes ^= kgram_hashes >> numpy.uint64(31)
+    kgram_hashes *= numpy.uint64(0x94D049BB133111EB)
+    kgram_hashes ^= kgram_hashes >> numpy.uint64(29)
+    window_size = min(window_size, num_kgrams)
+    # Break the ties between equal hashes by position, so that every window has a
+    # single smallest k-gram even where the source code repeats itself
+    keys = (kgram_hashes >> numpy.uint64(24) << numpy.uint64(24)) | (
+        numpy.arange(num_kgrams, dtype=numpy.uint64) & numpy.uint64(0xFFFFFF)
+    )
+    window_minimums = sliding_window_reduce(keys, window_size, numpy.minimum)
+    # A k-gram is selected if it is the smallest of any of the windows it is part of,
+    # i.e. if it equals the largest of the minimums of those windows
+    padding = numpy.zeros(window_size - 1, dtype=numpy.uint64)
+    selected = keys == sliding_window_reduce(
+        numpy.concatenate((padding, window_minimums, padding)), window_size, numpy.maximum
+    )
+    positions = numpy.flatnonzero(selected)
+    return (kgram_hashes[positions], positions)
+
+
+def sliding_window_reduce(values, window_size, reduce):
+    """Reduce every window of consecutive values with numpy.minimum or numpy.maximum
+
+    Uses the van Herk/Gil-Werman algorithm: the values are split in blocks of the
+    window size, and every window is made of the end of a block and the start of
+    the next one, so it takes linear time whatever the window size.
+    """
+    num_blocks = -(-len(values) // window_size)
+    identity = numpy.iinfo(values.dtype).max if reduce is numpy.minimum else 0
+    blocks = numpy.full(num_blocks * window_size, identity, dtype=values.dtype)
+    blocks[: len(values)] = values
+    blocks = blocks.reshape(num_blocks, window_size)
+    block_prefixes = reduce.accumulate(blocks, axis=1).ravel()
+    block_suffixes = reduce.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    return reduce(
+        block_suffixes[: len(values) - window_size + 1],
+        block_prefixes[window_size - 1 : len(values)],
+    )
+
+
+def find_duplicate_fragments(files_token_hashes, min_tokens, query_indices=None):
+    """Find the fragments of at least min_tokens tokens duplicated between files
+
+    The fingerprints of all the files are sorted by hash, which groups the places
+    where the same k-gram appears without comparing every pair of files. Files
+    sharing a fingerprint are then compared token by token along the alignment
+    given by the positions of the fingerprint, to find the exact duplicated
+    fragments. Returns a dict mapping pairs of file indices, the first one of a
+    queried file, to lists of (start, end, other start, other end) token ranges.
+    """
+    kgram_size = min(fragment_kgram_size, min_tokens)
+    window_size = min_tokens - kgram_size + 1
+    is_queried = numpy.ones(len(files_token_hashes), dtype=bool)
+    if query_indices is not None:
+        is_queried[:] = False
+        is_queried[query_indices] = True
+
+    fingerprints = [
+        get_fingerprints(token_hashes, kgram_size, window_size)
+        for token_hashes in files_token_hashes
+    ]
+    hashes = numpy.concatenate([h for h, _ in fingerprints] + [numpy.zeros(0, numpy.uint64)])
+    positions = numpy.concatenate([p for _, p in fingerprints] + [numpy.zeros(0, numpy.int64)])
+    file_indices = numpy.repeat(
+        numpy.arange(len(fingerprints)), [len(h) for h, _ in fingerprints]
+    )
+    order = numpy.argsort(hashes, kind="stable")
+    hashes, positions, file_indices = hashes[order], positions[order], file_indices[order]
+    group_starts = numpy.flatnonzero(
+        numpy.concatenate(([True], hashes[1:] != hashes[:-1]))
+    )
+    group_ends = numpy.append(group_starts[1:], len(hashes))
+    group_sizes = group_ends - group_starts
+    shared = (group_sizes >= 2) & (group_sizes <= fragment_max_occurrences)
+
+    # Every ordered pair of places of the same fingerprint, grouped by the number of
+    # places of the fingerprint so that the pairs are generated for all at once
+    first_places = [numpy.zeros(0, dtype=numpy.int64)]
+    second_places = [numpy.zeros(0, dtype=numpy.int64)]
+    for group_size in numpy.unique(group_sizes[shared]).tolist():
+        places = group_starts[shared & (group_sizes == group_size)][:, None] + numpy.arange(
+            group_size
+        )
+        first_places.append(numpy.repeat(places, group_size, axis=1).ravel())
+        second_places.append(numpy.tile(places, (1, group_size)).ravel())
+    first_places = numpy.concatenate(first_places)
+    second_places = numpy.concatenate(second_places)
+    first_files = file_indices[first_places]
+    second_files = file_indices[second_places]
+    # Compare each pair of files once, in the order of their indices, unless only
+    # the first one is queried
+    is_pair = (
+        (first_files != second_files)
+        & is_queried[first_files]
+        & ((first_files < second_files) | ~is_queried[second_files])
+    )
+    first_files, second_files = first_files[is_pair], second_files[is_pair]
+    first_positions = positions[first_places[is_pair]]
+    offsets = positions[second_places[is_pair]] - first_positions
+
+    # Group the shared fingerprints of every pair of files by their alignment
+    order = numpy.lexsort((first_positions, offsets, second_files, first_files))
+    first_files, second_files = first_files[order], second_files[order]
+    first_positions, offsets = first_positions[order], offsets[order]
+    alignment_starts = numpy.flatnonzero(
+        numpy.concatenate(
+            (
+                [True],
+                (first_files[1:] != first_files[:-1])
+                | (second_files[1:] != second_files[:-1])
+                | (offsets[1:] != offsets[:-1]),
+            )
+        )
+    )
+    alignment_ends = numpy.append(alignment_starts[1:], len(first_files))
+
+    # Most alignments with a single shared fingerprint are a coincidence. Keep only
+    # those whose identical k-grams extend to min_tokens identical tokens, checking
+    # all of them at once.
+    all_tokens = numpy.concatenate(
+        [numpy.asarray(h) for h in files_token_hashes] + [numpy.zeros(0, numpy.uint32)]
+    )
+    file_offsets = numpy.zeros(len(files_token_hashes) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(h) for h in files_token_hashes], out=file_offsets[1:])
+    file_lengths = numpy.diff(file_offsets)
+    single = alignment_starts[alignment_ends - alignment_starts == 1]
+    extended_lengths = numpy.full(len(single), kgram_size)
+    for direction, first_distance in ((-1, 1), (1, kgram_size)):
+        # The alignments whose identical tokens may extend further in this direction
+        extending = numpy.arange(len(single))
+        for distance in range(first_distance, first_distance + window_size - 1):
+            first_file = first_files[single[extending]]
+            second_file = second_files[single[extending]]
+            first = first_positions[single[extending]] + direction * distance
+            second = first + offsets[single[extending]]
+            is_extended = (
+                (first >= 0)
+                & (second >= 0)
+                & (first < file_lengths[first_file])
+                & (second < file_lengths[second_file])
+            )
+            first = numpy.where(is_extended, file_offsets[first_file] + first, 0)
+            second = numpy.where(is_extended, file_offsets[second_file] + second, 0)
+            is_extended &= all_tokens[first] == all_tokens[second]
+            extending = extending[is_extended]
+            extended_lengths[extending] += 1
+    is_kept = alignment_ends - alignment_starts > 1
+    is_kept[numpy.searchsorted(alignment_starts, single)] = extended_lengths >= min_tokens
+    alignment_starts, alignment_ends = alignment_starts[is_kept], alignment_ends[is_kept]
+
+    fragments = dict()
+    for file_index, other_index, offset, first_position, last_position in zip(
+        first_files[alignment_starts].tolist(),
+        second_files[alignment_starts].tolist(),
+        offsets[alignment_starts].tolist(),
+        first_positions[alignment_starts].tolist(),
+        first_positions[alignment_ends - 1].tolist(),
+    ):
+        tokens = all_tokens[file_offsets[file_index] : file_offsets[file_index + 1]]
+        other_tokens = all_tokens[file_offsets[other_index] : file_offsets[other_index + 1]]
+        # Identical tokens around the fingerprints, up to a window away, may be
+        # part of the same fragment, and so may the tokens beyond if still identical
+        min_start = max(0, -offset)
+        max_end = min(len(tokens), len(other_tokens) - offset)
+        start = max(first_position - window_size, min_start)
+        end = min(last_position + kgram_size + window_size, max_end)
+        while start > min_start and tokens[start - 1] == other_tokens[start - 1 + offset]:
+            start -= 1
+        while end < max_end and tokens[end] == other_tokens[end + offset]:
+            end += 1
+        is_equal = numpy.concatenate(
+            ([False], tokens[start:end] == other_tokens[start + offset : end + offset], [False])
+        )
+        changes = numpy.flatnonzero(is_equal[1:] != is_equal[:-1])
+        for run_start, run_end in zip(changes[::2].tolist(), changes[1::2].tolist()):
+            if run_end - run_start < min_tokens:
+                continue
+            fragment = (start + run_start, start + run_end)
+            other_fragment = (fragment[0] + offset, fragment[1] + offset)
+            fragments.setdefault((file_index, other_index), list()).append(
+                fragment + other_fragment
+            )
+            if is_queried[other_index]:
+                fragments.setdefault((other_index, file_index), list()).append(
+                    other_fragment + fragment
+                )
+    for pair, file_fragments in fragments.items():
+        # Drop the fragments that are part of larger ones in both files, which are
+        # found when the duplicated code repeats itself
+        file_fragments.sort(key=lambda fragment: fragment[0] - fragment[1])
+        largest_fragments = list()
+        for start, end, other_start, other_end in file_fragments:
+            if not any(
+                larger[0] <= start and end <= larger[1]
+                and larger[2] <= other_start and other_end <= larger[3]
+                for larger in largest_fragments
+            ):
+                largest_fragments.append((start, end, other_start, other_end))
+        fragments[pair] = sorted(largest_fragments)
+    return fragments
+
+
+def fragment_similarity_rows(fragments, files_token_hashes, query_indices, top_k=0):
+    """Yield, for every queried file, the (file index, similarity) of the files it
+    shares fragments with, by file index or by descending similarity if top_k is set
+
+    The similarity is the fraction of the tokens of the queried file that are
+    part of fragments duplicated in the other file.
+    """
+    other_indices = dict()
+    for file_index, other_index in fragments:
+        other_indices.setdefault(file_index, list()).append(other_index)
+    for query_index in query_indices:
+        num_tokens = len(files_token_hashes[query_index])
+        row = list()
+        for other_index in sorted(other_indices.get(query_index, list())):
+            covered_tokens = 0
+            covered_end = 0
+            for start, end, _, _ in fragments[(query_index, other_index)]:
+                covered_tokens += max(end - max(start, covered_end), 0)
+                covered_end = max(covered_end, end)
+            row.append((other_index, covered_tokens / num_tokens))
+        if top_k:
+            row = sorted(row, key=lambda entry: -entry[1])[:top_k]
+        yield row
+
+
+def get_fragment_spans(file_fragments, token_lines, other_token_lines):
+    """Get the first and last lines of the duplicated fragments of two files"""
+    return [
+        {
+            fragment_line_label: [int(token_lines[start]), int(token_lines[end - 1])],
+            fragment_other_line_label: [
+                int(other_token_lines[other_start]),
+                int(other_token_lines[other_end - 1]),
+            ],
+        }
+        for start, end, other_start, other_end in file_fragments
+    ]
+
+
+class JsonObjectWriter:
+    """Write a JSON object one entry at a time
+
+    The output is identical to printing json.dumps(obj, indent=4) of the whole
+    object, but the object never has to be held in memory.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.entries_written = 0
+
+    def write(self, key, value):
+        self.stream.write("{\n" if self.entries_written == 0 else ",\n")
+        value_json = json.dumps(value, indent=4).replace("\n", "\n    ")
+        self.stream.write("    %s: %s" % (json.dumps(key), value_json))
+        self.entries_written += 1
+
+    def close(self):
+        self.stream.write("{}\n" if self.entries_written == 0 else "\n}\n")
+
+
+def write_csv_rows(writer, source_file, file_similarity, show_loc):
+    """Write the similarities of a file to the other files as CSV rows
+
+    If the similarities come with duplicated fragments, one row is written per
+    fragment, with the line spans of the fragment in both files.
+    """
+    for other_file, similarity in file_similarity.items():
+        if other_file == loc_label:
+            continue
+        if isinstance(similarity, dict) and fragments_label in similarity:
+            loc_columns = [list(), list()]
+            if show_loc:
+                loc_columns = [
+                    [get_loc_to_print(file_similarity[loc_label])],
+                    [get_loc_to_print(similarity[loc_label])],
+                ]
+            for fragment_span in similarity[fragments_label]:
+                writer.writerow(
+                    [source_file]
+                    + loc_columns[0]
+                    + ["%d-%d" % tuple(fragment_span[fragment_line_label]), other_file]
+                    + loc_columns[1]
+                    + [
+                        "%d-%d" % tuple(fragment_span[fragment_other_line_label]),
+                        similarity[similarity_label],
+                    ]
+                )
+        elif show_loc:
+            writer.writerow(
+                [
+                    source_file,
+                    get_loc_to_print(file_similarity[loc_label]),
+                    other_file,
+                    get_loc_to_print(similarity[loc_label]),
+                    similarity[similarity_label],
+                ]
+            )
+        else:
+            writer.writerow([source_file, other_file, similarity])
+
+
+def write_results(
+    result_rows,
+    fail_threshold,
+    json_output,
+    csv_output,
+    show_loc,
+    largest_string_length,
+    fragments_reported,
+    keep_results,
+    profiler,
+):
+    """Print the results of every file as text or JSON, and write them to the
+    CSV file if one is given
+
+    result_rows yields the results of every file, as the result_rows of run()
+    do. Returns the exit code and, if keep_results is set, the similarities of
+    every file.
+    """
+    column_label = file_column_label
+    if show_loc:
+        column_label += file_loc_label
+        largest_string_length += len(file_loc_label)
+
+    exit_code = ReturnCode.SUCCESS
+    code_similarity = dict()
+    json_writer = JsonObjectWriter(sys.stdout) if json_output else None
+    csv_file = open(csv_output, "w") if csv_output else None
+    csv_writer = csv.writer(csv_file) if csv_file else None
+    if csv_writer:
+        if fragments_reported:
+            if show_loc:
+                csv_writer.writerow(
+                    ["File A", "#LoC A", "Lines A", "File B", "#LoC B", "Lines B", "Similarity"]
+                )
+            else:
+                csv_writer.writerow(["File A", "Lines A", "File B", "Lines B", "Similarity"])
+        elif show_loc:
+            csv_writer.writerow(["File A", "#LoC A", "File B", "#LoC B", "Similarity"])
+        else:
+            csv_writer.writerow(["File A", "File B", "Similarity"])
+
+    for short_source_file_path, source_file_loc, similar_files in result_rows:
+        loc_info = ""
+        if show_loc:
+            loc_info = "," + get_loc_to_print(source_file_loc)
+
+        conditional_print(
+            "\n\n\n"
+            + CliColors.HEADER
+            + "Code duplication probability for "
+            + short_source_file_path
+            + loc_info
+            + CliColors.ENDC,
+            json_output,
+        )
+        conditional_print(
+            "-" * (largest_string_length + similarity_label_length), json_output
+        )
+        conditional_print(
+            CliColors.BOLD
+            + "%s %s"
+            % (column_label.center(largest_string_length), similarity_column_label)
+            + CliColors.ENDC,
+            json_output,
+        )
+        conditional_print(
+            "-" * (largest_string_length + similarity_label_length), json_output
+        )
+
+        file_similarity = dict()
+        if show_loc:
+            file_similarity[loc_label] = source_file_loc
+        empty_length = len(file_similarity)
+        for short_source_path, source_loc, similarity_percentage, fragment_spans in (
+            similar_files
+        ):
+            if show_loc:
+                file_similarity[short_source_path] = dict()
+                file_similarity[short_source_path][loc_label] = source_loc
+                file_similarity[short_source_path][similarity_label] = round(
+                    similarity_percentage, 2
+                )
+            else:
+                file_similarity[short_source_path] = round(similarity_percentage, 2)
+            if fragment_spans is not None:
+                if not show_loc:
+                    file_similarity[short_source_path] = {
+                        similarity_label: file_similarity[short_source_path]
+                    }
+                file_similarity[short_source_path][fragments_label] = fragment_spans
+            if similarity_percentage > fail_threshold:
+                exit_code = ReturnCode.THRESHOLD_EXCEEDED
+            color = (
+                CliColors.OKGREEN
+                if similarity_percentage < 10
+                else (
+                    CliColors.WARNING if similarity_percentage < 20 else CliColors.FAIL
+                )
+            )
+            info_to_print = short_source_path
+            if show_loc:
+                info_to_print += "," + get_loc_to_print(source_loc)
+
+            conditional_print(
+                "%s     " % (info_to_print.ljust(largest_string_length))
+                + color
+                + "%.2f" % (similarity_percentage)
+                + CliColors.ENDC,
+                json_output,
+            )
+            for fragment_span in fragment_spans or list():
+                conditional_print(
+                    "    lines %d-%d match lines %d-%d"
+                    % tuple(
+                        fragment_span[fragment_line_label]
+                        + fragment_span[fragment_other_line_label]
+                    ),
+                    json_output,
+                )
+        # If no similarities found for the particular file, leave it out of the report
+        if len(file_similarity) == empty_length:
+            continue
+        profiler.count("files", 1)
+        profiler.count("pairs", len(file_similarity) - empty_length)
+        # Emit the results of the file right away, so they never have to be kept
+        # in memory for all the files at once
+        if json_writer:
+            json_writer.write(short_source_file_path, file_similarity)
+        if csv_writer:
+            write_csv_rows(csv_writer, short_source_file_path, file_similarity, show_loc)
+        if keep_results:
+            code_similarity[short_source_file_path] = file_similarity
+    if exit_code == ReturnCode.THRESHOLD_EXCEEDED:
+        conditional_print(
+            "Code duplication threshold exceeded. Please consult logs.", json_output
+        )
+
+    if json_writer:
+        json_writer.close()
+    if csv_file:
+        csv_file.close()
+    return (exit_code, code_similarity)
+
+
+def parse_shard(shard):
+    """Parse a shard given as I/N, the I-th of N shards"""
+    try:
+        shard_number, shards = (int(n) for n in shard.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shards are given as I/N, e.g. 2/4")
+    if not 1 <= shard_number <= shards:
+        raise argparse.ArgumentTypeError("the shard must be between 1 and %d" % shards)
+    return (shard_number, shards)
+
+
+def write_shard(
+    shard_output,
+    shard,
+    row_count,
+    largest_string_length,
+    fragments_reported,
+    positioned_rows,
+    fail_threshold,
+):
+    """Write the results of the rows of a shard to a JSON lines file
+
+    The first line describes the shard and every other line holds the results
+    of a file, as yielded by the result_rows of run(), along with its position
+    in the results of all the shards. Returns the exit code of the shard.
+    """
+    exit_code = ReturnCode.SUCCESS
+    with open(shard_output, "w") as f:
+        header = {
+            "shard": list(shard),
+            "rows": row_count,
+            "largest_string_length": largest_string_length,
+            "fragments": fragments_reported,
+        }
+        f.write(json.dumps(header) + "\n")
+        for position, (source_file, source_loc, similar_files) in positioned_rows:
+            row = {
+                "position": position,
+                "file": source_file,
+                "loc": source_loc,
+                "similar_files": similar_files,
+            }
+            f.write(json.dumps(row) + "\n")
+            if any(similarity > fail_threshold for _, _, similarity, _ in similar_files):
+                exit_code = ReturnCode.THRESHOLD_EXCEEDED
+    return exit_code
+
+
+def merge_shards(
+    shard_files,
+    fail_threshold,
+    json_output,
+    csv_output,
+    show_loc,
+    ignore_threshold=0,
+    keep_results=True,
+    save_similarities=None,
+):
+    """Combine the results of all the shards of a run, written by write_shard,
+    into the same outputs as a run without shards"""
+    headers = dict()
+    rows = list()
+    for shard_file in shard_files:
+        try:
+            with open(shard_file, "r") as f:
+                header = json.loads(f.readline())
+                shard_rows = [json.loads(line) for line in f]
+        except (OSError, ValueError) as err:
+            print(f"Failed to read shard {shard_file}, reason: {str(err)}")
+            return (ReturnCode.BAD_INPUT, {})
+        headers[tuple(header.pop("shard"))] = header
+        rows += shard_rows
+    shards = {shards for _, shards in headers}
+    settings = {json.dumps(header, sort_keys=True) for header in headers.values()}
+    if (
+        len(shards) != 1
+        or len(settings) != 1
+        or set(headers) != {(i, len(headers)) for i in range(1, len(headers) + 1)}
+    ):
+        print("The shards are not all the shards of the same run")
+        return (ReturnCode.BAD_INPUT, {})
+    header = headers[(1, len(headers))]
+    rows.sort(key=lambda row: row["position"])
+    if [row["position"] for row in rows] != list(range(header["rows"])):
+        print("The shards are missing results or have results of the same files")
+        return (ReturnCode.BAD_INPUT, {})
+
+    profiler = Profiler(enabled=False)
+    profiler.start("output")
+    result_rows = (
+        (
+            row["file"],
+            row["loc"],
+            [
+                similar_file
+                for similar_file in row["similar_files"]
+                if similar_file[2] >= ignore_threshold
+            ],
+        )
+        for row in rows
+    )
+    archive = None
+    if save_similarities:
+        archive = SimilarityArchive(header["largest_string_length"], header["fragments"])
+        result_rows = archive.record(result_rows)
+    result = write_results(
+        result_rows,
+        fail_threshold,
+        json_output,
+        csv_output,
+        show_loc,
+        header["largest_string_length"],
+        header["fragments"],
+        keep_results,
+        profiler,
+    )
+    if archive:
+        archive.save(save_similarities)
+    return result
+
+
+class SimilarityArchive:
+    """The results of a run, kept compactly to be saved and reported again later
+
+    The similarity percentages are stored as the float32 values of a sparse
+    matrix, with a row for every queried file and a column for every file,
+    saved in a .npz file along with the paths and the numbers of lines of the
+    files and the line spans of the duplicated fragments, if any. Only the
+    similarities reported by the run, i.e. not below its ignore threshold, are kept.
+    """
+
+    format_version = 1
+
+    def __init__(self, largest_string_length, fragments_reported):
+        self.largest_string_length = largest_string_length
+        self.fragments_reported = fragments_reported
+        self.files = list()
+        self.file_indices = dict()
+        self.loc_counts = array("q")
+        self.row_files = array("I")
+        self.indptr = array("q", [0])
+        self.indices = array("I")
+        self.data = array("f")
+        self.fragment_spans = list()
+
+    def get_file_index(self, source_file, loc_count):
+        if source_file not in self.file_indices:
+            self.file_indices[source_file] = len(self.files)
+            self.files.append(source_file)
+            self.loc_counts.append(loc_count)
+        return self.file_indices[source_file]
+
+    def record(self, result_rows):
+        """Keep the results yielded by the result_rows of run() while passing
+        them on"""
+        for source_file, source_loc, similar_files in result_rows:
+            self.row_files.append(self.get_file_index(source_file, source_loc))
+            for other_file, other_loc, similarity_percentage, spans in similar_files:
+                self.indices.append(self.get_file_index(other_file, other_loc))
+                self.data.append(similarity_percentage)
+                if self.fragments_reported:
+                    self.fragment_spans.append(spans)
+            self.indptr.append(len(self.indices))
+            yield (source_file, source_loc, similar_files)
+
+    def result_rows(self, ignore_threshold=0):
+        """Yield the results in the same format as the result_rows of run()"""
+        indptr = self.indptr.tolist()
+        files = self.files
+        loc_counts = self.loc_counts.tolist()
+        for row, file_index in enumerate(self.row_files.tolist()):
+            similar_files = list()
+            for k in range(indptr[row], indptr[row + 1]):
+                similarity_percentage = float(self.data[k])
+                if similarity_percentage < ignore_threshold:
+                    continue
+                other_index = self.indices[k]
+                similar_files.append(
+                    (
+                        files[other_index],
+                        loc_counts[other_index],
+                        similarity_percentage,
+                        self.fragment_spans[k] if self.fragments_reported else None,
+                    )
+                )
+            yield (files[file_index], loc_counts[file_index], similar_files)
+
+    def get_similarities(self):
+        """Get a dict mapping every (file, other file) pair to its similarity"""
+        similarities = dict()
+        indptr = self.indptr.tolist()
+        for row, file_index in enumerate(self.row_files.tolist()):
+            for k in range(indptr[row], indptr[row + 1]):
+                pair = (self.files[file_index], self.files[self.indices[k]])
+                similarities[pair] = float(self.data[k])
+        return similarities
+
+    def save(self, path):
+        metadata = {
+            "format_version": self.format_version,
+            "largest_string_length": self.largest_string_length,
+            "fragments": self.fragments_reported,
+            "files": self.files,
+            "fragment_spans": self.fragment_spans,
+        }
+        # numpy adds the .npz suffix to paths that do not have it, so the file is
+        # opened here to keep the given path
+        with open(path, "wb") as f:
+            numpy.savez_compressed(
+                f,
+                metadata=numpy.frombuffer(json.dumps(metadata).encode(), dtype=numpy.uint8),
+                loc_counts=numpy.frombuffer(self.loc_counts, dtype=numpy.int64),
+                row_files=numpy.frombuffer(self.row_files, dtype=numpy.uint32),
+                indptr=numpy.frombuffer(self.indptr, dtype=numpy.int64),
+                indices=numpy.frombuffer(self.indices, dtype=numpy.uint32),
+                data=numpy.frombuffer(self.data, dtype=numpy.float32),
+            )
+
+    @classmethod
+    def load(cls, path):
+        """Load saved results, raising ValueError if they are not readable"""
+        with numpy.load(path) as saved:
+            metadata = json.loads(saved["metadata"].tobytes().decode())
+            if metadata.get("format_version") != cls.format_version:
+                raise ValueError("unsupported format version")
+            archive = cls(metadata["largest_string_length"], metadata["fragments"])
+            archive.files = metadata["files"]
+            archive.file_indices = {f: i for i, f in enumerate(archive.files)}
+            archive.fragment_spans = metadata["fragment_spans"]
+            archive.loc_counts = array("q", saved["loc_counts"].astype(numpy.int64).tobytes())
+            archive.row_files = array("I", saved["row_files"].astype(numpy.uint32).tobytes())
+            archive.indptr = array("q", saved["indptr"].astype(numpy.int64).tobytes())
+            archive.indices = array("I", saved["indices"].astype(numpy.uint32).tobytes())
+            archive.data = array("f", saved["data"].astype(numpy.float32).tobytes())
+        return archive
+
+
+def load_similarities(
+    path,
+    fail_threshold,
+    json_output,
+    csv_output,
+    show_loc,
+    ignore_threshold=0,
+    keep_results=True,
+):
+    """Report the results saved by a run with --save-similarities again, with
+    other thresholds or outputs, without computing them"""
+    try:
+        archive = SimilarityArchive.load(path)
+    except (OSError, KeyError, ValueError) as err:
+        print(f"Failed to load the similarities from {path}, reason: {str(err)}")
+        return (ReturnCode.BAD_INPUT, {})
+    profiler = Profiler(enabled=False)
+    profiler.start("output")
+    return write_results(
+        archive.result_rows(ignore_threshold),
+        fail_threshold,
+        json_output,
+        csv_output,
+        show_loc,
+        archive.largest_string_length,
+        archive.fragments_reported,
+        keep_results,
+        profiler,
+    )
+
+
+def diff_similarities(
+    old_path, new_path, fail_threshold, json_output, ignore_threshold=0
+):
+    """Report the pairs of files that are more similar in the results saved by
+    a run than in the ones saved by an earlier run
+
+    Pairs missing from the earlier results count as 0% similar. Only pairs at
+    least ignore_threshold percent similar in the later results are reported,
+    from the one whose similarity grew the most.
+    """
+    similarities = list()
+    for path in (old_path, new_path):
+        try:
+            similarities.append(SimilarityArchive.load(path).get_similarities())
+        except (OSError, KeyError, ValueError) as err:
+            print(f"Failed to load the similarities from {path}, reason: {str(err)}")
+            return (ReturnCode.BAD_INPUT, {})
+    old_similarities, new_similarities = similarities
+    changes = sorted(
+        (
+            (new_similarity - old_similarities.get(pair, 0.0), pair, new_similarity)
+            for pair, new_similarity in new_similarities.items()
+            if new_similarity >= ignore_threshold
+            and new_similarity > old_similarities.get(pair, 0.0)
+        ),
+        key=lambda change: (-change[0], change[1]),
+    )
+
+    exit_code = ReturnCode.SUCCESS
+    code_similarity = dict()
+    for change, (source_file, other_file), new_similarity in changes:
+        old_similarity = old_similarities.get((source_file, other_file), 0.0)
+        code_similarity.setdefault(source_file, dict())[other_file] = {
+            similarity_before_label: round(old_similarity, 2),
+            similarity_label: round(new_similarity, 2),
+        }
+        if new_similarity > fail_threshold:
+            exit_code = ReturnCode.THRESHOLD_EXCEEDED
+        conditional_print(
+            "%s  %s     %.2f -> %.2f (+%.2f)"
+            % (source_file, other_file, old_similarity, new_similarity, change),
+            json_output,
+        )
+    if json_output:
+        print(json.dumps(code_similarity, indent=4))
+    elif not changes:
+        print("No pairs of files are more similar than before")
+    return (exit_code, code_similarity)
+
+
+def get_peak_rss():
+    """Get the peak resident memory of the process in megabytes, or None where it
+    is not available"""
+    if resource is None:
+        return None
+    # The maximum resident set size is given in bytes on macOS and in kilobytes elsewhere
+    unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+
+
+class Profiler:
+    """Record the wall time, CPU time, peak memory and counters of the stages of a run
+
+    Stages run one after the other, starting a stage stops the previous one.
+    Work done lazily while another stage runs, e.g. computing the similarities
+    while the results are written out, is recorded with iterate() as a separate
+    stage, and its time is not counted in the running stage.
+
+    The peak memory of a stage is the high-water mark of the process when the
+    stage ends, which includes the memory of the previous stages. A disabled
+    profiler records nothing, so it costs nothing.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.start_time = time.perf_counter()
+        self.stages = dict()
+        self.current_stage = None
+        self.current_stage_start = None
+
+    def get_stage(self, name, lazy=False):
+        if name not in self.stages:
+            self.stages[name] = {
+                "start": time.perf_counter() - self.start_time,
+                "lazy": lazy,
+                "wall_time": 0.0,
+                "cpu_time": 0.0,
+                "peak_rss_so_far": None,
+                "workers_peak_rss": None,
+                "steps": dict(),
+                "counters": dict(),
+            }
+        return self.stages[name]
+
+    def start(self, name):
+        if not self.enabled:
+            return
+        self.stop()
+        self.current_stage = self.get_stage(name)
+        self.current_stage_start = (time.perf_counter(), time.process_time())
+
+    def stop(self):
+        if self.current_stage is None:
+            return
+        wall_start, cpu_start = self.current_stage_start
+        self.current_stage["wall_time"] += time.perf_counter() - wall_start
+        self.current_stage["cpu_time"] += time.process_time() - cpu_start
+        self.update_peak_rss(self.current_stage)
+        self.current_stage = None
+
+    @staticmethod
+    def update_peak_rss(stage):
+        stage["peak_rss_so_far"] = get_peak_rss()
+
+    def count(self, counter, value=1):
+        """Add the value to a counter of the running stage"""
+        if not self.enabled:
+            return
+        counters = self.current_stage["counters"]
+        counters[counter] = counters.get(counter, 0) + value
+
+    def add_preprocessing_stats(self, stats, in_workers):
+        """Record the statistics gathered by map_timed_source_files in the running
+        stage, adding the CPU time and memory of the worker processes, if any
+
+        The time of every step is summed over all the files, which may have been
+        processed in parallel.
+        """
+        if not self.enabled:
+            return
+        steps = self.current_stage["steps"]
+        for step, step_time in stats.get("steps", dict()).items():
+            steps[step] = steps.get(step, 0.0) + step_time
+        if in_workers:
+            self.current_stage["cpu_time"] += stats.get("cpu_time", 0.0)
+            self.current_stage["workers_peak_rss"] = stats.get("peak_rss")
+
+    def iterate(self, name, iterable, counter="items"):
+        """Iterate, recording the time spent to get every item in its own stage"""
+        if not self.enabled:
+            return iter(iterable)
+        return self.iterate_stage(self.get_stage(name, lazy=True), iterable, counter)
+
+    def iterate_stage(self, stage, iterable, counter):
+        iterator = iter(iterable)
+        while True:
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                wall_time = time.perf_counter() - wall_start
+                cpu_time = time.process_time() - cpu_start
+                stage["wall_time"] += wall_time
+                stage["cpu_time"] += cpu_time
+                self.update_peak_rss(stage)
+                if self.current_stage is not None:
+                    self.current_stage_start = (
+                        self.current_stage_start[0] + wall_time,
+                        self.current_stage_start[1] + cpu_time,
+                    )
+            stage["counters"][counter] = stage["counters"].get(counter, 0) + 1
+            yield item
+
+    def get_report(self):
+        """Get the recorded stages, in the order they started, and the totals
+
+        Times are given in seconds and memory in megabytes.
+        """
+        self.stop()
+        stages = sorted(self.stages.items(), key=lambda item: item[1]["start"])
+        workers_peak_rss = [
+            stage["workers_peak_rss"]
+            for stage in self.stages.values()
+            if stage["workers_peak_rss"] is not None
+        ]
+        return {
+            "stages": [
+                {
+                    "stage": name,
+                    "start": stage["start"],
+                    "lazy": stage["lazy"],
+                    "wall_time": stage["wall_time"],
+                    "cpu_time": stage["cpu_time"],
+                    "peak_rss_so_far": stage["peak_rss_so_far"],
+                    "workers_peak_rss": stage["workers_peak_rss"],
+                    "steps": stage["steps"],
+                    "counters": stage["counters"],
+                }
+                for name, stage in stages
+            ],
+            "total": {
+                "wall_time": time.perf_counter() - self.start_time,
+                "cpu_time": sum(stage["cpu_time"] for stage in self.stages.values()),
+                "peak_rss": get_peak_rss(),
+                "workers_peak_rss": max(workers_peak_rss, default=None),
+            },
+        }
+
+    @staticmethod
+    def format_table(report):
+        """Format a report as a table, with the steps indented under their stage"""
+        row_format = "%-24s %10s %10s %22s   %s"
+        lines = [
+            row_format
+            % ("Stage", "Wall (s)", "CPU (s)", "Peak RSS so far (MB)", "Counters")
+        ]
+        total = dict(
+            report["total"], stage="total", peak_rss_so_far=report["total"]["peak_rss"]
+        )
+        for stage in report["stages"] + [total]:
+            counters = " ".join("%s=%d" % item for item in stage.get("counters", {}).items())
+            peak_rss = stage["peak_rss_so_far"]
+            peak_rss = "-" if peak_rss is None else "%.1f" % peak_rss
+            lines.append(
+                row_format
+                % (
+                    stage["stage"],
+                    "%.3f" % stage["wall_time"],
+                    "%.3f" % stage["cpu_time"],
+                    peak_rss,
+                    counters,
+                )
+            )
+            for step, step_time in stage.get("steps", {}).items():
+                lines.append(row_format % ("  " + step, "%.3f" % step_time, "", "", ""))
+        return "\n".join(line.rstrip() for line in lines)
+
+    @staticmethod
+    def get_chrome_trace(report):
+        """Get a report as trace events, which can be viewed with chrome://tracing
+        or Perfetto, keeping the whole report next to them"""
+        events = list()
+        for stage in report["stages"]:
+            events.append(
+                {
+                    "name": stage["stage"],
+                    "ph": "X",
+                    "ts": stage["start"] * 1e6,
+                    "dur": stage["wall_time"] * 1e6,
+                    "pid": os.getpid(),
+                    # Lazy stages are interleaved with the others
+                    "tid": 2 if stage["lazy"] else 1,
+                    "args": {
+                        "cpu_time": stage["cpu_time"],
+                        "peak_rss_so_far": stage["peak_rss_so_far"],
+                        "workers_peak_rss": stage["workers_peak_rss"],
+                        **stage["steps"],
+                        **stage["counters"],
+                    },
+                }
+            )
+        return dict(report, traceEvents=events, displayTimeUnit="ms")
+
+
+def get_tf_idf_rows(vectors, idfs, num_features):
+    """Get the TF-IDF vectors of (token ids, token counts) arrays as the unit-length
+    rows of a sparse matrix
+
+    Equivalent to weighting the vectors with a gensim TfidfModel and passing them to
+    get_tf_idf_matrix, but computed with vectorized operations on whole arrays.
+    """
+    lengths = numpy.array([len(token_ids) for token_ids, _ in vectors], dtype=numpy.int64)
+    indptr = numpy.zeros(len(vectors) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=indptr[1:])
+    token_ids = numpy.concatenate(
+        [numpy.asarray(token_ids, dtype=numpy.int64) for token_ids, _ in vectors]
+        + [numpy.zeros(0, dtype=numpy.int64)]
+    )
+    token_counts = numpy.concatenate(
+        [numpy.asarray(token_counts, dtype=numpy.float64) for _, token_counts in vectors]
+        + [numpy.zeros(0, dtype=numpy.float64)]
+    )
+    weights = token_counts * idfs[token_ids]
+    rows = numpy.repeat(numpy.arange(len(vectors)), lengths)
+    norms = numpy.sqrt(numpy.bincount(rows, weights=weights**2, minlength=len(vectors)))
+    norms[norms == 0] = 1
+    weights /= norms[rows]
+    return scipy.sparse.csr_matrix(
+        (weights.astype(numpy.float32), token_ids, indptr),
+        shape=(len(vectors), num_features),
+    )
+
+
+class DuplicateDetector:
+    """Keep the bag-of-words vectors of documents and find their similarities
+
+    Documents are named, usually after the path of their file, and can be added,
+    updated and removed at any time. The document frequencies of the tokens are
+    updated along with the vectors, so the TF-IDF model never has to be rebuilt
+    from the source code. Documents are ordered by name, so the rows of the
+    similarities and their document indices follow the order of names.
+
+    With num_features, tokens are hashed into that many features instead of
+    being kept in the dictionary, which then only holds the statistics of the
+    features, so the memory of the model does not grow with the vocabulary.
+    Tokens found in fewer than min_df documents or in more than a max_df share
+    of them are left out of the similarities.
+    """
+
+    def __init__(
+        self,
+        only_code=False,
+        tokenizer="nltk",
+        dictionary=None,
+        num_features=0,
+        min_df=1,
+        max_df=1.0,
+    ):
+        self.only_code = only_code
+        self.tokenizer = tokenizer
+        if dictionary is None:
+            dictionary = gensim.corpora.Dictionary()
+        self.dictionary = dictionary
+        self.num_features = num_features
+        self.min_df = min_df
+        self.max_df = max_df
+        self.document_frequencies = numpy.zeros(0, dtype=numpy.int64)
+        self.vectors = dict()
+        self.loc_counts = dict()
+        self.sorted_names = None
+        self.tf_idf_matrix = None
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def __contains__(self, name):
+        return name in self.vectors
+
+    @property
+    def names(self):
+        if self.sorted_names is None:
+            self.sorted_names = sorted(self.vectors)
+        return self.sorted_names
+
+    def get_num_features(self):
+        return self.num_features or len(self.dictionary)
+
+    def get_vector(self, tokens, allow_update=False):
+        """Get the (token ids, token counts) arrays of tokens, adding the unknown
+        tokens to the dictionary if allow_update is set and ignoring them otherwise"""
+        if self.num_features:
+            return get_hashed_vector(tokens, self.num_features)
+        bow = self.dictionary.doc2bow(tokens, allow_update=allow_update)
+        return (
+            array("I", (token_id for token_id, _ in bow)),
+            array("I", (count for _, count in bow)),
+        )
+
+    def set_vector(self, name, token_ids, token_counts, loc_count):
+        self.remove_document(name)
+        if self.get_num_features() > len(self.document_frequencies):
+            self.document_frequencies = numpy.concatenate(
+                [
+                    self.document_frequencies,
+                    numpy.zeros(
+                        self.get_num_features() - len(self.document_frequencies),
+                        dtype=numpy.int64,
+                    ),
+                ]
+            )
+        self.document_frequencies[numpy.asarray(token_ids)] += 1
+        self.vectors[name] = (token_ids, token_counts)
+        self.loc_counts[name] = loc_count
+        self.sorted_names = None
+        self.tf_idf_matrix = None
+
+    def get_tokens(self, source_code, name=""):
+        """Tokenize source code, the extension of the name telling its language"""
+        if self.only_code:
+            _, file_extension = os.path.splitext(name)
+            source_code = remove_comments_and_docstrings(source_code, file_extension[1:])
+        return tokenize(source_code, self.tokenizer)
+
+    def add_document(self, name, source_code):
+        """Add the source code as a document, replacing any document of the same name"""
+        tokens = self.get_tokens(source_code, name)
+        self.set_vector(
+            name, *self.get_vector(tokens, allow_update=True), count_lines(source_code)
+        )
+
+    update_document = add_document
+
+    def remove_document(self, name):
+        vector = self.vectors.pop(name, None)
+        if vector is not None:
+            self.document_frequencies[numpy.asarray(vector[0])] -= 1
+            del self.loc_counts[name]
+            self.sorted_names = None
+            self.tf_idf_matrix = None
+
+    def add_files(
+        self,
+        source_code_files,
+        jobs=1,
+        cache=None,
+        stats=None,
+        blob_ids=None,
+        blob_reader=None,
+    ):
+        """Add or update the documents of source code files, named by their paths
+
+        The files are processed in parallel if jobs > 1. Files cached in the
+        CorpusCache, if given, are not tokenized again, and the ones tokenized are
+        added to it. If stats is given, the preprocessing statistics are gathered
+        in it (see map_timed_source_files) and the number of tokens and of cached
+        files are added to its "tokens" and "cached_files" entries. If blob_ids
+        is given, the files are read from git through the blob_reader instead,
+        see preprocess_git_files. The documents of files that cannot be read are
+        removed. Returns a dict with the error message of every such file.
+        """
+        errors = dict()
+        if blob_ids is not None:
+            preprocessed_files = preprocess_git_files(
+                source_code_files,
+                blob_ids,
+                blob_reader,
+                self.only_code,
+                cache,
+                jobs,
+                self.tokenizer,
+                stats,
+                self.num_features,
+            )
+        else:
+            preprocessed_files = preprocess_source_files(
+                source_code_files,
+                self.only_code,
+                cache,
+                jobs,
+                self.tokenizer,
+                stats,
+                self.num_features,
+            )
+        for source_code_file, (cache_key, tokens, loc_count, error) in zip(
+            source_code_files, preprocessed_files
+        ):
+            if error is not None:
+                errors[source_code_file] = error
+                self.remove_document(source_code_file)
+                continue
+            if tokens is None:
+                token_ids, token_counts, loc_count = cache.get(cache_key)
+            else:
+                if self.num_features:
+                    # The tokens were hashed while preprocessing the file
+                    token_ids, token_counts = tokens
+                else:
+                    token_ids, token_counts = self.get_vector(tokens, allow_update=True)
+                if cache:
+                    cache.put(cache_key, token_ids, token_counts, loc_count)
+            if stats is not None:
+                if tokens is None:
+                    stats["cached_files"] = stats.get("cached_files", 0) + 1
+                else:
+                    stats["tokens"] = stats.get("tokens", 0) + sum(token_counts)
+            self.set_vector(source_code_file, token_ids, token_counts, loc_count)
+        return errors
+
+    def get_kept_tokens(self):
+        """Get a mask of the token ids within the document frequency limits, or
+        None if all of them are kept"""
+        if self.min_df <= 1 and self.max_df >= 1.0:
+            return None
+        return (self.document_frequencies >= self.min_df) & (
+            self.document_frequencies <= self.max_df * len(self.vectors)
+        )
+
+    def get_corpus(self):
+        """Get the vectors of all the documents as a corpus, in the order of names,
+        without the tokens outside the document frequency limits"""
+        corpus = CompactCorpus()
+        kept_tokens = self.get_kept_tokens()
+        for name in self.names:
+            token_ids, token_counts = self.vectors[name]
+            if kept_tokens is not None:
+                token_ids = numpy.asarray(token_ids, dtype=numpy.int64)
+                kept = kept_tokens[token_ids]
+                token_ids = array("I", token_ids[kept].tolist())
+                token_counts = array(
+                    "I", numpy.asarray(token_counts)[kept].tolist()
+                )
+            corpus.append_arrays(token_ids, token_counts)
+        return corpus
+
+    def update_dictionary_statistics(self):
+        """Make the document frequencies of the dictionary describe exactly the
+        documents, which is not the case once documents are removed or when the
+        dictionary has been accumulated over several runs, e.g. in the cache"""
+        document_frequencies = self.document_frequencies
+        kept_tokens = self.get_kept_tokens()
+        if kept_tokens is not None:
+            document_frequencies = document_frequencies * kept_tokens
+        token_ids = numpy.flatnonzero(document_frequencies)
+        self.dictionary.dfs = dict(
+            zip(token_ids.tolist(), document_frequencies[token_ids].tolist())
+        )
+        # The collection frequencies are summed over the vectors of the documents
+        collection_frequencies = numpy.zeros(len(document_frequencies), dtype=numpy.int64)
+        for vector_token_ids, vector_token_counts in self.vectors.values():
+            collection_frequencies[numpy.asarray(vector_token_ids)] += vector_token_counts
+        if kept_tokens is not None:
+            collection_frequencies *= kept_tokens
+        self.dictionary.cfs = dict(
+            zip(token_ids.tolist(), collection_frequencies[token_ids].tolist())
+        )
+        self.dictionary.num_docs = len(self.vectors)
+        self.dictionary.num_pos = int(collection_frequencies.sum())
+        self.dictionary.num_nnz = int(document_frequencies.sum())
+
+    def get_tf_idf_model(self):
+        self.update_dictionary_statistics()
+        return gensim.models.TfidfModel(dictionary=self.dictionary)
+
+    def get_idfs(self):
+        """Get the inverse document frequencies, the same way as gensim's TfidfModel"""
+        with numpy.errstate(divide="ignore"):
+            idfs = numpy.log2(len(self.vectors) / self.document_frequencies)
+        idfs[self.document_frequencies == 0] = 0
+        kept_tokens = self.get_kept_tokens()
+        if kept_tokens is not None:
+            idfs[~kept_tokens] = 0
+        return idfs
+
+    def get_tf_idf_matrix(self):
+        """Get the TF-IDF vectors of the documents as the unit-length columns of a
+        sparse matrix, in the order of names"""
+        if self.tf_idf_matrix is None:
+            self.tf_idf_matrix = get_tf_idf_rows(
+                [self.vectors[name] for name in self.names],
+                self.get_idfs(),
+                self.get_num_features(),
+            ).T.tocsc()
+        return self.tf_idf_matrix
+
+    def compare_vectors(self, vectors):
+        """Get the similarities of (token ids, token counts) arrays against all the
+        documents, as the rows of a dense array, capped at 1 like the rows of the
+        similarity engines"""
+        query_matrix = get_tf_idf_rows(
+            vectors, self.get_idfs(), self.get_num_features()
+        )
+        return numpy.minimum((query_matrix @ self.get_tf_idf_matrix()).toarray(), 1.0)
+
+    def similarity_rows(
+        self,
+        query_indices=None,
+        similarity_engine="gensim",
+        top_k=0,
+        top_k_method="exact",
+        index_backend="auto",
+        index_memory_limit=1024,
+    ):
+        """Yield the similarities of every queried document (all of them by default)
+        against all the documents, as iterables of (document index, similarity)
+
+        The similarities are computed lazily, one row at a time, with the "gensim"
+        or the "matrix" similarity engine. With top_k, only the top_k most similar
+        documents of every row are kept, sorted by descending similarity.
+        """
+        corpus = self.get_corpus()
+        tf_idf = self.get_tf_idf_model()
+        num_features = self.get_num_features()
+        if top_k and top_k_method == "minhash":
+            return minhash_similarity_rows(
+                tf_idf[corpus], num_features, corpus, top_k, query_indices
+            )
+        if similarity_engine == "matrix":
+            similarity_rows = matrix_similarity_rows(
+                tf_idf[corpus], num_features, query_indices
+            )
+        else:
+            if index_backend == "auto":
+                index_backend = select_index_backend(corpus, index_memory_limit)
+            similarity_rows = gensim_similarity_rows(
+                tf_idf[corpus], num_features, query_indices, index_backend
+            )
+        if top_k:
+            row_indices = query_indices if query_indices else range(len(corpus))
+            return top_k_similarity_rows(similarity_rows, top_k, row_indices)
+        return (enumerate(row) for row in similarity_rows)
+
+    def get_similarities(self, name, similarities, top_k=0, min_similarity=0.0):
+        """Map the other documents to their similarities, from the most similar"""
+        names = self.names
+        similarities = sorted(
+            (
+                (min(float(similarity), 1.0), names[i])
+                for i, similarity in similarities
+                if names[i] != name and similarity >= min_similarity
+            ),
+            key=lambda item: (-item[0], item[1]),
+        )
+        if top_k:
+            similarities = similarities[:top_k]
+        return {other_name: similarity for similarity, other_name in similarities}
+
+    def query(self, names=None, top_k=0, min_similarity=0.0, similarity_engine="matrix"):
+        """Get the similarities of documents (all of them by default) against all
+        the other documents
+
+        Returns a dict mapping the name of every queried document to a dict of the
+        names of the other documents and their similarities, between 0 and 1, from
+        the most similar one. Only the top_k most similar documents, if top_k is
+        set, with at least min_similarity are included.
+        """
+        document_indices = {name: i for i, name in enumerate(self.names)}
+        if names is None:
+            names = self.names
+        query_indices = [document_indices[name] for name in names]
+        similarity_rows = self.similarity_rows(
+            query_indices, similarity_engine, top_k
+        )
+        return {
+            name: self.get_similarities(name, similarities, top_k, min_similarity)
+            for name, similarities in zip(names, similarity_rows)
+        }
+
+    def query_source(self, source_code, name="", top_k=0, min_similarity=0.0):
+        """Get the similarities of source code against all the documents, without
+        adding it to them, in the same format as the results of query()"""
+        vector = self.get_vector(self.get_tokens(source_code, name))
+        similarities = self.compare_vectors([vector])[0]
+        return self.get_similarities(
+            name, enumerate(similarities), top_k, min_similarity
+        )
+
+
+class SimilarityServer:
+    """Keep the analyzed files in a DuplicateDetector and answer similarity queries
+
+    The supplied directories are polled for changes and only the files that were
+    added, modified or removed since the previous poll are processed again.
+    """
 
+    def __init__(
+        self,
+        directories,
+        files,
+        ignore_directories,
+        ignore_files,
+        project_root_dir,
+        file_extensions,
+        only_code,
+        ignore_patterns=None,
+        use_gitignore=False,
+        tokenizer="nltk",
+        num_features=0,
+        min_df=1,
+        max_df=1.0,
+    ):
+        self.directories = directories
+        self.files = files
+        self.ignore_directories = ignore_directories
+        self.ignore_files = {os.path.abspath(f) for f in ignore_files or list()}
+        self.project_root_dir = project_root_dir
+        self.file_extensions = file_extensions
+        self.only_code = only_code
+        self.ignore_patterns = ignore_patterns or list()
+        self.use_gitignore = use_gitignore
+        self.tokenizer = tokenizer
+        self.lock = threading.Lock()
+        self.detector = DuplicateDetector(
+            only_code, tokenizer, None, num_features, min_df, max_df
+        )
+        self.file_stats = dict()
 
-class ReturnCode(Enum):
-    SUCCESS = 0
-    BAD_INPUT = 1
-    THRESHOLD_EXCEEDED = 2
+    def list_source_code_files(self):
+        source_code_files = list()
+        if self.directories:
+            for directory in self.directories:
+                source_code_files += get_all_source_code_from_directory(
+                    directory,
+                    self.file_extensions,
+                    self.ignore_directories,
+                    self.ignore_patterns,
+                    self.use_gitignore,
+                )
+        else:
+            source_code_files = [f for f in self.files if os.path.isfile(f)]
+        source_code_files = {os.path.abspath(f) for f in source_code_files}
+        return source_code_files - self.ignore_files
 
+    def get_file_stat(self, source_code_file):
+        try:
+            stat = os.stat(source_code_file)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
 
-class CliColors:
-    HEADER = "\033[95m"
-    OKBLUE = "\033[94m"
-    OKGREEN = "\033[92m"
-    WARNING = "\033[93m"
-    FAIL = "\033[91m"
-    ENDC = "\033[0m"
-    BOLD = "\033[1m"
-    UNDERLINE = "\033[4m"
+    def update_files(self, source_code_files, jobs=1):
+        """Process again the files whose size or modification time changed"""
+        changed_files = list()
+        for source_code_file in source_code_files:
+            stat = self.get_file_stat(source_code_file)
+            if stat is None:
+                self.detector.remove_document(source_code_file)
+                self.file_stats.pop(source_code_file, None)
+            elif stat != self.file_stats.get(source_code_file):
+                self.file_stats[source_code_file] = stat
+                changed_files.append(source_code_file)
+        errors = self.detector.add_files(changed_files, jobs)
+        for source_code_file, error in errors.items():
+            print(f"ERROR: Failed to open file {source_code_file}, reason: {error}")
+        return len(changed_files)
 
+    def refresh(self, jobs=1):
+        """Bring the vectors up to date with the files on disk
 
-def get_all_source_code_from_directory(directory, file_extensions):
-    """Get a list with all the source code files within the directory"""
-    source_code_files = list()
-    for dirpath, _, filenames in os.walk(directory):
-        for name in filenames:
-            _, file_extension = os.path.splitext(name)
-            if file_extension[1:] in file_extensions:
-                filename = os.path.join(dirpath, name)
-                source_code_files.append(filename)
+        Returns the number of files that were added, modified or removed.
+        """
+        source_code_files = self.list_source_code_files()
+        removed_files = set(self.file_stats) - source_code_files
+        for source_code_file in removed_files:
+            self.detector.remove_document(source_code_file)
+            del self.file_stats[source_code_file]
+        return len(removed_files) + self.update_files(sorted(source_code_files), jobs)
 
-    return source_code_files
+    def query(self, query_files, ignore_threshold=0, fail_threshold=100, top_k=0, show_loc=False):
+        """Get the similarities of the queried files against all the analyzed files
 
+        Queried files that are not among the analyzed ones are compared without
+        being added to them. Returns the exit code and the similarities in the
+        same format as run().
+        """
+        query_files = sorted({os.path.abspath(f) for f in query_files} - self.ignore_files)
+        query_files = [
+            f for f in query_files if os.path.splitext(f)[1][1:] in self.file_extensions
+        ]
+        with self.lock:
+            # The queried files may have changed since the last poll
+            self.update_files([f for f in query_files if f in self.file_stats])
+            # Files that cannot be read are skipped, so the vectors are kept along
+            # with the files they belong to
+            vector_files = list()
+            query_vectors = list()
+            query_loc_counts = list()
+            for query_file in query_files:
+                if query_file in self.detector:
+                    vector_files.append(query_file)
+                    query_vectors.append(self.detector.vectors[query_file])
+                    query_loc_counts.append(self.detector.loc_counts[query_file])
+                    continue
+                _, tokens, loc_count, error = preprocess_source_file(
+                    query_file, self.only_code, tokenizer=self.tokenizer
+                )
+                if error is not None:
+                    print(f"ERROR: Failed to open file {query_file}, reason: {error}")
+                    continue
+                vector_files.append(query_file)
+                query_vectors.append(self.detector.get_vector(tokens))
+                query_loc_counts.append(loc_count)
+            similarity_rows = self.detector.compare_vectors(query_vectors)
+            analyzed_files = self.detector.names
+            loc_counts = self.detector.loc_counts.copy()
 
-def conditional_print(text, machine_friendly_output):
-    if not machine_friendly_output:
-        print(text)
+        exit_code = ReturnCode.SUCCESS
+        code_similarity = dict()
+        for query_file, query_loc_count, similarities in zip(
+            vector_files, query_loc_counts, similarity_rows
+        ):
+            if query_file in loc_counts:
+                similarities[analyzed_files.index(query_file)] = -numpy.inf
+            indices = range(len(similarities))
+            if top_k:
+                indices = numpy.argsort(-similarities, kind="stable")[:top_k]
+                indices = [i for i in indices if similarities[i] != -numpy.inf]
+            file_similarity = dict()
+            if show_loc:
+                file_similarity[loc_label] = query_loc_count
+            empty_length = len(file_similarity)
+            for source_index in indices:
+                similarity_percentage = float(similarities[source_index] * 100)
+                if similarity_percentage < ignore_threshold:
+                    continue
+                source = analyzed_files[source_index]
+                short_source_path = source.replace(self.project_root_dir, "")
+                if show_loc:
+                    file_similarity[short_source_path] = {
+                        loc_label: loc_counts[source],
+                        similarity_label: round(similarity_percentage, 2),
+                    }
+                else:
+                    file_similarity[short_source_path] = round(similarity_percentage, 2)
+                if similarity_percentage > fail_threshold:
+                    exit_code = ReturnCode.THRESHOLD_EXCEEDED
+            if len(file_similarity) > empty_length:
+                code_similarity[query_file.replace(self.project_root_dir, "")] = file_similarity
+        return (exit_code, code_similarity)
 
+    def watch(self, interval):
+        """Poll the analyzed files for changes every interval seconds"""
+        while True:
+            time.sleep(interval)
+            with self.lock:
+                self.refresh()
 
-def remove_comments_and_docstrings(source_code: str) -> str:
-    """Strip comments and docstrings from source code
 
-    .. seealso::
+class SimilarityRequestHandler(socketserver.StreamRequestHandler):
+    """Answer a query sent as a line of JSON with a line of JSON
 
-        https://gist.github.com/phpdude/1ae6f19de213d66286c8183e9e3b9ec1
+    A query is an object with the "query_files" to compare and optionally the
+    "ignore_threshold", "fail_threshold", "top_k" and "show_loc" settings. The
+    response has the "exit_code" and the "similarities" of the queried files.
+    """
 
-    :param source_code: Raw source code as a single string
-    :type source_code: str
-    :return: Stripped source code as a single string
-    :rtype: str
+    def handle(self):
+        request_line = self.rfile.readline()
+        if not request_line:
+            # The connection was closed without a query, e.g. by serve() probing
+            # whether a server is already listening
+            return
+        try:
+            request = json.loads(request_line)
+            exit_code, code_similarity = self.server.similarity_server.query(
+                request["query_files"],
+                request.get("ignore_threshold", 0),
+                request.get("fail_threshold", 100),
+                request.get("top_k", 0),
+                request.get("show_loc", False),
+            )
+            response = {"exit_code": exit_code.value, "similarities": code_similarity}
+        except Exception as err:
+            response = {"exit_code": ReturnCode.BAD_INPUT.value, "error": str(err)}
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+def serve(socket_path, similarity_server, watch_interval, jobs=1):
+    """Serve similarity queries on a Unix socket until interrupted"""
+    if os.path.exists(socket_path):
+        # Remove the socket left behind by a server that is no longer running
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            try:
+                client.connect(socket_path)
+                print("A server is already listening on", socket_path)
+                return ReturnCode.BAD_INPUT
+            except OSError:
+                os.remove(socket_path)
+
+    with similarity_server.lock:
+        num_files = similarity_server.refresh(jobs)
+        similarity_server.detector.get_tf_idf_matrix()
+    watcher = threading.Thread(
+        target=similarity_server.watch, args=(watch_interval,), daemon=True
+    )
+    watcher.start()
+    # Stop the same way on SIGTERM as on Ctrl+C, so the socket is removed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    with socketserver.UnixStreamServer(socket_path, SimilarityRequestHandler) as server:
+        server.similarity_server = similarity_server
+        print(f"Analyzed {num_files} files, listening on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+    return ReturnCode.SUCCESS
+
+
+def preprocess_fragment_files(source_code_files, only_code, jobs, profiler):
+    """Get the hashes and the line numbers of the tokens of the files, for the
+    fragments engine
+
+    Returns the files that could be read, their numbers of lines and the
+    (token hashes, token line numbers) of each of them.
     """
-    parsed = ast.parse(source_code)
-    for node in ast.walk(parsed):
-        if not isinstance(
-            node, (ast.FunctionDef, ast.ClassDef, ast.AsyncFunctionDef, ast.Module)
-        ):
+    analyzed_files = list()
+    loc_counts = dict()
+    files_tokens = list()
+    # The preprocessing statistics are only gathered when profiling
+    preprocessing_stats = dict() if profiler.enabled else None
+    preprocess = functools.partial(preprocess_fragment_source_file, only_code=only_code)
+    if preprocessing_stats is not None:
+        results = map_timed_source_files(
+            preprocess, source_code_files, jobs, preprocessing_stats
+        )
+    else:
+        results = map_source_files(preprocess, source_code_files, jobs)
+    for source_code_file, (token_hashes, token_lines, loc_count, error) in zip(
+        source_code_files, results
+    ):
+        if error is not None:
+            print(f"ERROR: Failed to open file {source_code_file}, reason: {error}")
+            profiler.count("errors")
             continue
+        files_tokens.append((token_hashes, token_lines))
+        profiler.count("tokens", len(token_hashes))
+        analyzed_files.append(source_code_file)
+        loc_counts[source_code_file] = loc_count
+    if preprocessing_stats is not None:
+        profiler.add_preprocessing_stats(preprocessing_stats, jobs > 1)
+    profiler.count("files", len(analyzed_files))
+    return (analyzed_files, loc_counts, files_tokens)
 
-        if not len(node.body):
-            continue
 
-        if not isinstance(node.body[0], ast.Expr):
-            continue
+def get_duplicate_detector(
+    source_code_files,
+    only_code,
+    tokenizer,
+    jobs,
+    profiler,
+    cache_dir=str(),
+    num_features=0,
+    min_df=1,
+    max_df=1.0,
+    blob_ids=None,
+    git_repository_root=None,
+):
+    """Get a DuplicateDetector with the documents of the files
 
-        if not hasattr(node.body[0], "value") or not isinstance(
-            node.body[0].value, ast.Str
-        ):
-            continue
+    The files are read from git if blob_ids is given (see find_source_code_files)
+    and are cached in cache_dir, if set, along with the dictionary.
+    """
+    # Parse the contents of all the source files, tokenizing each file once and
+    # keeping only its compact bag-of-words vector
+    cache = None
+    if cache_dir:
+        cache = CorpusCache(
+            cache_dir,
+            "%s|only_code=%s|features=%d" % (tokenizer, bool(only_code), num_features),
+            hashed=num_features > 0,
+        )
+    detector = DuplicateDetector(
+        only_code,
+        tokenizer,
+        cache.dictionary if cache and not num_features else None,
+        num_features,
+        min_df,
+        max_df,
+    )
+    # The preprocessing statistics are only gathered when profiling
+    preprocessing_stats = dict() if profiler.enabled else None
+    blob_reader = None
+    if blob_ids is not None:
+        blob_reader = GitBlobReader(git_repository_root)
+    try:
+        errors = detector.add_files(
+            source_code_files,
+            jobs,
+            cache,
+            preprocessing_stats,
+            blob_ids,
+            blob_reader,
+        )
+    finally:
+        if blob_reader:
+            blob_reader.close()
+    for source_code_file, error in errors.items():
+        print(f"ERROR: Failed to open file {source_code_file}, reason: {error}")
+    if preprocessing_stats is not None:
+        profiler.add_preprocessing_stats(preprocessing_stats, jobs > 1)
+        if cache:
+            profiler.count("cached files", preprocessing_stats.get("cached_files", 0))
+        profiler.count("tokens", preprocessing_stats.get("tokens", 0))
+    profiler.count("errors", len(errors))
+    profiler.count("files", len(detector))
 
-        node.body = node.body[1:]
+    profiler.start("tf-idf model")
+    if cache:
+        detector.update_dictionary_statistics()
+        cache.save()
+    if num_features:
+        profiler.count("used features", numpy.count_nonzero(detector.document_frequencies))
+    else:
+        profiler.count("vocabulary", len(detector.dictionary))
+    return detector
 
-    source_code_clean = astor.to_source(parsed)
-    return source_code_clean
 
+class SimilarityResults:
+    """The similarities of the queried files against all the analyzed files, in
+    the rows reported by run()
 
-def get_loc_count(file_path):
-    lines_count = -1
-    try:
-        with open(os.path.normpath(file_path), 'r') as the_file:
-            lines_count = len(the_file.readlines())
-    except Exception as err:
-        print(f"WARNING: Failed to get lines count for file {file_path}, reason: {str(err)}")
-    return lines_count
+    The similarities are computed lazily, one row at a time, while result_rows()
+    is iterated. With a shard, only the rows of a contiguous block of the queried
+    files are computed and row_positions holds the position of every row in the
+    results of all the shards, out of row_count rows.
+    """
 
+    def __init__(self, analyzed_files, loc_counts, query_files=None, shard=None):
+        self.analyzed_files = list(analyzed_files)
+        self.analyzed_file_indices = {f: i for i, f in enumerate(self.analyzed_files)}
+        self.loc_counts = dict(loc_counts)
+        self.query_files = query_files
+        self.query_indices = None
+        self.queried_files = list(self.analyzed_files)
+        if query_files is not None:
+            self.query_indices = [
+                i for i, f in enumerate(self.analyzed_files) if f in query_files
+            ]
+            self.queried_files = [self.analyzed_files[i] for i in self.query_indices]
+        self.row_positions = list(range(len(self.queried_files)))
+        self.row_count = len(self.queried_files)
+        if shard is not None:
+            # Only the rows of a contiguous block of the queried files are computed
+            shard_number, shards = shard
+            start = len(self.queried_files) * (shard_number - 1) // shards
+            end = len(self.queried_files) * shard_number // shards
+            self.query_indices = [
+                self.analyzed_file_indices[f] for f in self.queried_files[start:end]
+            ]
+            self.queried_files = self.queried_files[start:end]
+            self.row_positions = self.row_positions[start:end]
+        # The rows of (file index, similarity), set by the similarity engine
+        self.similarity_rows = None
+        # The duplicated fragments and the line numbers of the tokens of every
+        # file, with the fragments engine
+        self.fragments = None
+        self.token_lines = None
+        # The indices of the collapsed duplicates mapped to the indices of the
+        # files they were collapsed to
+        self.representative_indices = dict()
 
-def get_loc_to_print(loc_count):
-    loc_to_print = str(loc_count) if loc_count >= 0 else ""
-    return loc_to_print
+    def get_row_indices(self):
+        """Get the indices of the queried files, in the order of the rows"""
+        if self.query_indices is not None:
+            return self.query_indices
+        return range(len(self.analyzed_files))
+
+    def find_fragments(self, files_tokens, min_fragment_tokens, top_k=0):
+        """Compute the similarities from the fragments duplicated between files,
+        given the (token hashes, token line numbers) of every analyzed file"""
+        files_token_hashes = [token_hashes for token_hashes, _ in files_tokens]
+        self.token_lines = [token_lines for _, token_lines in files_tokens]
+        self.fragments = find_duplicate_fragments(
+            files_token_hashes, min_fragment_tokens, self.query_indices
+        )
+        self.similarity_rows = fragment_similarity_rows(
+            self.fragments, files_token_hashes, self.get_row_indices(), top_k
+        )
+
+    def add_duplicates(self, duplicate_files, duplicate_loc_counts, top_k=0):
+        """Give every duplicate collapsed by find_duplicate_files the similarities
+        of the file it was collapsed to"""
+        row_indices = self.get_row_indices()
+        shard_row_indices = set(row_indices)
+        duplicate_indices = dict()
+        duplicate_rows = list()
+        for representative in sorted(duplicate_files):
+            if representative not in self.analyzed_file_indices:
+                continue
+            representative_index = self.analyzed_file_indices[representative]
+            for duplicate in duplicate_files[representative]:
+                duplicate_index = len(self.analyzed_files)
+                self.analyzed_files.append(duplicate)
+                self.analyzed_file_indices[duplicate] = duplicate_index
+                self.loc_counts[duplicate] = duplicate_loc_counts[duplicate]
+                self.representative_indices[duplicate_index] = representative_index
+                duplicate_indices.setdefault(representative_index, list()).append(
+                    duplicate_index
+                )
+                if self.query_files is None or duplicate in self.query_files:
+                    # Duplicates are in the shard of the file they were collapsed to
+                    if representative_index in shard_row_indices:
+                        self.queried_files.append(duplicate)
+                        self.row_positions.append(self.row_count)
+                        duplicate_rows.append((duplicate_index, representative_index))
+                    self.row_count += 1
+        self.similarity_rows = duplicate_similarity_rows(
+            self.similarity_rows, row_indices, duplicate_indices, duplicate_rows, top_k
+        )
+
+    def get_fragment_spans(self, source_file, other_file):
+        """Get the line spans of the fragments duplicated between two files"""
+        loc_counts = self.loc_counts
+        pair = tuple(
+            self.representative_indices.get(index, index)
+            for index in (
+                self.analyzed_file_indices[source_file],
+                self.analyzed_file_indices[other_file],
+            )
+        )
+        if pair not in self.fragments:
+            # Collapsed duplicates are identical as a whole
+            return [
+                {
+                    fragment_line_label: [1, loc_counts[source_file]],
+                    fragment_other_line_label: [1, loc_counts[other_file]],
+                }
+            ]
+        return get_fragment_spans(
+            self.fragments[pair], self.token_lines[pair[0]], self.token_lines[pair[1]]
+        )
+
+    def result_rows(self, project_root_dir="", ignore_threshold=0, profiler=None):
+        """Yield the path, the number of lines and the similar files of every
+        queried file, with their paths, numbers of lines, similarity percentages
+        and duplicated fragments, if any"""
+        rows = self.similarity_rows
+        if profiler is not None:
+            rows = profiler.iterate("similarities", rows, "rows")
+        analyzed_files = self.analyzed_files
+        loc_counts = self.loc_counts
+        for source_file, similarities in zip(self.queried_files, rows):
+            similar_files = list()
+            for source_index, similarity in similarities:
+                source = analyzed_files[source_index]
+                # Ignore similarities for the same file
+                if source == source_file:
+                    continue
+                # Rounding errors must not make identical files more than 100% similar
+                similarity_percentage = float(min(similarity, 1.0) * 100)
+                # Ignore very low similarity
+                if similarity_percentage < ignore_threshold:
+                    continue
+                fragment_spans = None
+                if self.fragments is not None:
+                    fragment_spans = self.get_fragment_spans(source_file, source)
+                similar_files.append(
+                    (
+                        source.replace(project_root_dir, ""),
+                        loc_counts[source],
+                        similarity_percentage,
+                        fragment_spans,
+                    )
+                )
+            yield (
+                source_file.replace(project_root_dir, ""),
+                loc_counts[source_file],
+                similar_files,
+            )
 
 
 def main():
@@ -142,10 +3301,49 @@ def main():
         help="Check for similarities between specified files. \
                         The more files are supplied the more accurate are the results.",
     )
+    group.add_argument(
+        "--load-similarities",
+        metavar="SIMILARITIES_FILE",
+        help="Report the similarities saved by a run with --save-similarities, "
+        "instead of checking any files, e.g. with other thresholds or outputs.",
+    )
+    group.add_argument(
+        "--diff-similarities",
+        nargs=2,
+        metavar=("OLD_FILE", "NEW_FILE"),
+        help="Report the pairs of files that are more similar in NEW_FILE than in "
+        "OLD_FILE, both saved by runs with --save-similarities.",
+    )
+    group.add_argument(
+        "--merge-shards",
+        nargs="+",
+        metavar="SHARD_FILE",
+        help="Combine the results of all the shards of a run (see --shard) into the "
+        "usual outputs, instead of checking any files.",
+    )
     parser.add_argument(
         "--ignore-directories", nargs="+", default=list(), help="Directories to ignore."
     )
     parser.add_argument("--ignore-files", nargs="+", help="Files to ignore.")
+    parser.add_argument(
+        "--ignore-patterns",
+        nargs="+",
+        help="Glob patterns of directories or files to ignore, e.g. node_modules or "
+        "*_generated.py. Patterns with a slash are matched against the relative path.",
+    )
+    parser.add_argument(
+        "--use-gitignore",
+        action="store_true",
+        help="Skip the directories and files ignored by .gitignore files.",
+    )
+    parser.add_argument(
+        "--git",
+        action="store_true",
+        help="Only check the files tracked by git in the specified directories, "
+        "listing them with git and reading them from the repository in bulk. "
+        "Files modified in the worktree are read from disk. The directories must "
+        "be in the same repository.",
+    )
     parser.add_argument(
         "-j", "--json", type=bool, default=False, help="Print output as JSON."
     )
@@ -183,8 +3381,198 @@ def main():
         action="store_true",
         help="Add file line counts, including blank lines and comments, to all outputs.",
     )
+    parser.add_argument(
+        "--tokenizer",
+        choices=tokenizers,
+        default="nltk",
+        help="How source code is split into tokens: the NLTK word tokenizer, or a "
+        "faster source code lexer that does not need the punkt data.",
+    )
+    parser.add_argument(
+        "--similarity-engine",
+        choices=similarity_engines,
+        default="gensim",
+        help="How similarities are computed: a gensim index queried once per file, "
+        "all pairs at once as blocks of a sparse matrix product, or as the share of "
+        "each file made of fragments duplicated in the other files, which are "
+        "reported with their line spans.",
+    )
+    parser.add_argument(
+        "--min-fragment-tokens",
+        type=int,
+        default=40,
+        help="The minimum number of tokens of the fragments found by the fragments engine.",
+    )
+    parser.add_argument(
+        "--hash-features",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Hash the tokens into N features, e.g. 1048576, instead of keeping a "
+        "dictionary of all the tokens, so the memory of the model is bounded. "
+        "Unrelated tokens may share a feature, which is less likely the larger N is.",
+    )
+    parser.add_argument(
+        "--min-df",
+        type=int,
+        default=1,
+        help="Ignore the tokens found in fewer files than this.",
+    )
+    parser.add_argument(
+        "--max-df",
+        type=float,
+        default=1.0,
+        help="Ignore the tokens found in more than this share of the files, e.g. 0.5.",
+    )
+    parser.add_argument(
+        "--index-backend",
+        choices=index_backends,
+        default="auto",
+        help="Where the gensim engine keeps its index: in memory, or in a temporary "
+        "directory that is removed afterwards. By default chosen based on the index size.",
+    )
+    parser.add_argument(
+        "--index-memory-limit",
+        type=int,
+        default=1024,
+        help="The largest estimated index size (in MB) kept in memory by the auto backend.",
+    )
+    parser.add_argument(
+        "--collapse-duplicates",
+        action="store_true",
+        help="Report the files that are identical, apart from whitespace and comments, "
+        "as duplicates of one of them, which is the only one analyzed.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=str(),
+        help="Directory where the processed files are cached, so that only files "
+        "that changed since the previous run have to be processed again.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes used to read and tokenize the files, 0 for one per CPU.",
+    )
+    parser.add_argument(
+        "--query-files",
+        nargs="*",
+        help="Only report the similarities of the specified files (e.g. the changed ones) "
+        "against all the files of the specified directories or files.",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=0,
+        help="Only report the K most similar files for each file, 0 to report all of them.",
+    )
+    parser.add_argument(
+        "--top-k-method",
+        choices=top_k_methods,
+        default="exact",
+        help="How the most similar files are found when --top-k is set: exactly, "
+        "or approximately using MinHash signatures, which is faster for large projects "
+        "but can miss files that share few uncommon tokens.",
+    )
+    parser.add_argument(
+        "--serve",
+        nargs="?",
+        const=default_socket_path,
+        help="Keep the analyzed files in memory and answer queries of the "
+        "duplicate-code-detection-client on the specified Unix socket "
+        "(default: %s), updating the files that change." % default_socket_path,
+    )
+    parser.add_argument(
+        "--watch-interval",
+        type=float,
+        default=2,
+        help="How often (in seconds) the server checks the files for changes.",
+    )
+    parser.add_argument(
+        "--save-similarities",
+        metavar="SIMILARITIES_FILE",
+        help="Save the reported similarities to a compact .npz file, to be reported "
+        "again with --load-similarities or compared with --diff-similarities. "
+        "With --shard, save them when merging the shards instead.",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="I/N",
+        help="Only compute the similarities of the I-th of N blocks of the files, "
+        "e.g. 2/4, against all the files, and write them to the --shard-output "
+        "file, so a run can be split across machines and combined with --merge-shards.",
+    )
+    parser.add_argument(
+        "--shard-output",
+        type=str,
+        help="The file the results of the shard are written to "
+        "(default: shard-I-of-N.jsonl).",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=str(),
+        metavar="TRACE_FILE",
+        help="Print the time, memory and counters of every stage of the run to the "
+        "standard error, and write them to the specified JSON file, which can also "
+        "be opened as a trace in chrome://tracing or Perfetto.",
+    )
     args = parser.parse_args()
 
+    if args.load_similarities:
+        return load_similarities(
+            args.load_similarities,
+            args.fail_threshold,
+            args.json,
+            args.csv_output,
+            args.show_loc,
+            args.ignore_threshold,
+            keep_results=False,
+        )
+    if args.diff_similarities:
+        return diff_similarities(
+            *args.diff_similarities,
+            args.fail_threshold,
+            args.json,
+            args.ignore_threshold,
+        )
+    if args.merge_shards:
+        return merge_shards(
+            args.merge_shards,
+            args.fail_threshold,
+            args.json,
+            args.csv_output,
+            args.show_loc,
+            args.ignore_threshold,
+            keep_results=False,
+            save_similarities=args.save_similarities,
+        )
+
+    if args.serve:
+        project_root_dir = str()
+        if args.project_root_dir:
+            project_root_dir = os.path.join(os.path.abspath(args.project_root_dir), "")
+        similarity_server = SimilarityServer(
+            args.directories,
+            args.files,
+            args.ignore_directories,
+            args.ignore_files,
+            project_root_dir,
+            args.file_extensions,
+            args.only_code,
+            ignore_patterns=args.ignore_patterns,
+            use_gitignore=args.use_gitignore,
+            tokenizer=args.tokenizer,
+            num_features=args.hash_features,
+            min_df=args.min_df,
+            max_df=args.max_df,
+        )
+        jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+        return (serve(args.serve, similarity_server, args.watch_interval, jobs), {})
+
     result = run(
         args.fail_threshold,
         args.directories,
@@ -198,6 +3586,29 @@ def main():
         args.only_code,
         args.csv_output,
         args.show_loc,
+        args.similarity_engine,
+        args.cache_dir,
+        args.jobs if args.jobs > 0 else os.cpu_count(),
+        args.query_files,
+        top_k=args.top_k,
+        top_k_method=args.top_k_method,
+        ignore_patterns=args.ignore_patterns,
+        use_gitignore=args.use_gitignore,
+        index_backend=args.index_backend,
+        index_memory_limit=args.index_memory_limit,
+        tokenizer=args.tokenizer,
+        min_fragment_tokens=args.min_fragment_tokens,
+        collapse_duplicates=args.collapse_duplicates,
+        profile=args.profile,
+        git=args.git,
+        shard=args.shard,
+        shard_output=args.shard_output,
+        num_features=args.hash_features,
+        min_df=args.min_df,
+        max_df=args.max_df,
+        save_similarities=args.save_similarities,
+        # The results are printed or written to files while they are computed
+        keep_results=False,
     )
 
     return result
@@ -216,42 +3627,74 @@ def run(
     only_code,
     csv_output,
     show_loc,
+    similarity_engine="gensim",
+    cache_dir=str(),
+    jobs=1,
+    query_files=None,
+    keep_results=True,
+    top_k=0,
+    top_k_method="exact",
+    ignore_patterns=None,
+    use_gitignore=False,
+    index_backend="auto",
+    index_memory_limit=1024,
+    tokenizer="nltk",
+    min_fragment_tokens=40,
+    collapse_duplicates=False,
+    profile=None,
+    git=False,
+    shard=None,
+    shard_output=None,
+    num_features=0,
+    min_df=1,
+    max_df=1.0,
+    save_similarities=None,
 ):
+    profiler = Profiler(enabled=profile is not None)
+    if shard is not None and not shard_output:
+        shard_output = "shard-%d-of-%d.jsonl" % shard
+    if similarity_engine == "fragments" and min_fragment_tokens < 1:
+        print("The minimum number of tokens of the fragments must be positive")
+        return (ReturnCode.BAD_INPUT, {})
+    if num_features < 0 or min_df < 1 or not 0 < max_df <= 1:
+        print(
+            "The number of features must not be negative, the minimum document "
+            "frequency must be at least 1 and the maximum between 0 and 1"
+        )
+        return (ReturnCode.BAD_INPUT, {})
+    if shard is not None and save_similarities:
+        # A shard only holds part of the results
+        print(
+            "The similarities of a shard cannot be saved, "
+            "save them with --merge-shards instead"
+        )
+        return (ReturnCode.BAD_INPUT, {})
+
+    profiler.start("list files")
     # Determine which files to compare for similarities
-    source_code_files = list()
-    files_to_ignore = list()
-    if directories:
-        for directory in directories:
-            if not os.path.isdir(directory):
-                print("Path does not exist or is not a directory:", directory)
-                return (ReturnCode.BAD_INPUT, {})
-            source_code_files += get_all_source_code_from_directory(
-                directory, file_extensions
-            )
-        for directory in ignore_directories:
-            files_to_ignore += get_all_source_code_from_directory(
-                directory, file_extensions
+    try:
+        source_code_files, query_files, blob_ids, git_repository_root = (
+            find_source_code_files(
+                directories,
+                files,
+                file_extensions,
+                ignore_directories,
+                ignore_files,
+                ignore_patterns,
+                use_gitignore,
+                git,
+                query_files,
             )
-    else:
-        if len(files) < 2:
-            print("Too few files to compare, you need to supply at least 2")
-            return (ReturnCode.BAD_INPUT, {})
-        for supplied_file in files:
-            if not os.path.isfile(supplied_file):
-                print("Supplied file does not exist:", supplied_file)
-                return (ReturnCode.BAD_INPUT, {})
-        source_code_files = files
-
-    files_to_ignore += ignore_files if ignore_files else list()
-    files_to_ignore = [os.path.normpath(f) for f in files_to_ignore]
-    source_code_files = [os.path.normpath(f) for f in source_code_files]
-    source_code_files = list(set(source_code_files) - set(files_to_ignore))
-    if len(source_code_files) < 2:
-        print("Not enough source code files found")
+        )
+    except ValueError as err:
+        print(str(err))
         return (ReturnCode.BAD_INPUT, {})
-    # Sort the sources, so the results are sorted too and are reproducible
-    source_code_files.sort()
-    source_code_files = [os.path.abspath(f) for f in source_code_files]
+    if query_files is not None and not query_files:
+        conditional_print("No source code files to query", json_output)
+        if json_output:
+            print(json.dumps(dict()))
+        return (ReturnCode.SUCCESS, {})
+    profiler.count("files", len(source_code_files))
 
     # Get the absolute project root directory path to remove when printing out the results
     if project_root_dir:
@@ -269,162 +3712,95 @@ def run(
         max(source_code_files, key=len).replace(project_root_dir, "")
     )
 
-    # Parse the contents of all the source files
-    source_code = OrderedDict()
-    for source_code_file in source_code_files:
-        try:
-            # read file but also recover from encoding errors in source files
-            with open(source_code_file, "r", errors="surrogateescape") as f:
-                # Store source code with the file path as the key
-                content = f.read()
-                if only_code and source_code_file.endswith("py"):
-                    content = remove_comments_and_docstrings(content)
-                source_code[source_code_file] = content
-        except Exception as err:
-            print(f"ERROR: Failed to open file {source_code_file}, reason: {str(err)}")
-
-    # Create a Similarity object of all the source code
-    gen_docs = [
-        [word.lower() for word in word_tokenize(source_code[source_file])]
-        for source_file in source_code
-    ]
-    dictionary = gensim.corpora.Dictionary(gen_docs)
-    corpus = [dictionary.doc2bow(gen_doc) for gen_doc in gen_docs]
-    tf_idf = gensim.models.TfidfModel(corpus)
-    sims = gensim.similarities.Similarity(
-        tempfile.gettempdir() + os.sep, tf_idf[corpus], num_features=len(dictionary)
-    )
-
-    column_label = file_column_label
-    if show_loc:
-        column_label += file_loc_label
-        largest_string_length += len(file_loc_label)
-
-    exit_code = ReturnCode.SUCCESS
-    code_similarity = dict()
-    for source_file in source_code:
-        # Check for similarities
-        query_doc = [w.lower() for w in word_tokenize(source_code[source_file])]
-        query_doc_bow = dictionary.doc2bow(query_doc)
-        query_doc_tf_idf = tf_idf[query_doc_bow]
-
-        loc_info = ""
-        source_file_loc = -1
-        if show_loc:
-            source_file_loc = get_loc_count(source_file)
-            loc_info = "," + get_loc_to_print(source_file_loc)
+    # Files identical to another one, apart from whitespace and comments, are left
+    # out of the analysis and only reported as duplicates of that file
+    duplicate_files = dict()
+    if collapse_duplicates:
+        profiler.start("collapse duplicates")
+        duplicate_files, duplicate_loc_counts = find_duplicate_files(
+            source_code_files, jobs, query_files or ()
+        )
+        collapsed_files = {f for group in duplicate_files.values() for f in group}
+        source_code_files = [f for f in source_code_files if f not in collapsed_files]
+        profiler.count("duplicates", len(collapsed_files))
 
-        short_source_file_path = source_file.replace(project_root_dir, "")
-        conditional_print(
-            "\n\n\n"
-            + CliColors.HEADER
-            + "Code duplication probability for "
-            + short_source_file_path
-            + loc_info
-            + CliColors.ENDC,
-            json_output,
+    profiler.start("preprocess")
+    if similarity_engine == "fragments":
+        analyzed_files, loc_counts, files_tokens = preprocess_fragment_files(
+            source_code_files, only_code, jobs, profiler
         )
-        conditional_print(
-            "-" * (largest_string_length + similarity_label_length), json_output
+        results = SimilarityResults(analyzed_files, loc_counts, query_files, shard)
+        profiler.start("fragments")
+        results.find_fragments(files_tokens, min_fragment_tokens, top_k)
+        profiler.count("file pairs", len(results.fragments))
+        profiler.count("fragments", sum(map(len, results.fragments.values())))
+    else:
+        detector = get_duplicate_detector(
+            source_code_files,
+            only_code,
+            tokenizer,
+            jobs,
+            profiler,
+            cache_dir,
+            num_features,
+            min_df,
+            max_df,
+            blob_ids,
+            git_repository_root,
         )
-        conditional_print(
-            CliColors.BOLD
-            + "%s %s"
-            % (column_label.center(largest_string_length), similarity_column_label)
-            + CliColors.ENDC,
-            json_output,
+        results = SimilarityResults(
+            detector.names, detector.loc_counts, query_files, shard
         )
-        conditional_print(
-            "-" * (largest_string_length + similarity_label_length), json_output
+        results.similarity_rows = detector.similarity_rows(
+            results.query_indices,
+            similarity_engine,
+            top_k,
+            top_k_method,
+            index_backend,
+            index_memory_limit,
         )
+    if duplicate_files:
+        results.add_duplicates(duplicate_files, duplicate_loc_counts, top_k)
+    rows = results.result_rows(project_root_dir, ignore_threshold, profiler)
+    fragments_reported = results.fragments is not None
 
-        empty_length = 0
-        code_similarity[short_source_file_path] = dict()
-        if show_loc:
-            code_similarity[short_source_file_path][loc_label] = source_file_loc
-            empty_length = len(code_similarity[short_source_file_path])
-        for similarity, source in zip(sims[query_doc_tf_idf], source_code):
-            # Ignore similarities for the same file
-            if source == source_file:
-                continue
-            similarity_percentage = similarity * 100
-            # Ignore very low similarity
-            if similarity_percentage < ignore_threshold:
-                continue
-            short_source_path = source.replace(project_root_dir, "")
-            if show_loc:
-                code_similarity[short_source_file_path][short_source_path] = dict()
-                code_similarity[short_source_file_path][short_source_path][loc_label] = get_loc_count(
-                    source
-                )
-                code_similarity[short_source_file_path][short_source_path][similarity_label]  = round(
-                    similarity_percentage, 2
-                )
-            else:
-                code_similarity[short_source_file_path][short_source_path] = round(
-                    similarity_percentage, 2
-                )
-            if similarity_percentage > fail_threshold:
-                exit_code = ReturnCode.THRESHOLD_EXCEEDED
-            color = (
-                CliColors.OKGREEN
-                if similarity_percentage < 10
-                else (
-                    CliColors.WARNING if similarity_percentage < 20 else CliColors.FAIL
-                )
-            )
-            info_to_print = short_source_path
-            if show_loc:
-                info_to_print += "," + get_loc_to_print(get_loc_count(source))
-
-            conditional_print(
-                "%s     " % (info_to_print.ljust(largest_string_length))
-                + color
-                + "%.2f" % (similarity_percentage)
-                + CliColors.ENDC,
-                json_output,
-            )
-        # If no similarities found for the particular file, remove it from the report
-        if len(code_similarity[short_source_file_path]) == empty_length:
-            del code_similarity[short_source_file_path]
-    if exit_code == ReturnCode.THRESHOLD_EXCEEDED:
-        conditional_print(
-            "Code duplication threshold exceeded. Please consult logs.", json_output
+    profiler.start("output")
+    if shard is not None:
+        exit_code = write_shard(
+            shard_output,
+            shard,
+            results.row_count,
+            largest_string_length,
+            fragments_reported,
+            zip(results.row_positions, rows),
+            fail_threshold,
         )
+        code_similarity = dict()
+    else:
+        archive = None
+        if save_similarities:
+            archive = SimilarityArchive(largest_string_length, fragments_reported)
+            rows = archive.record(rows)
+        exit_code, code_similarity = write_results(
+            rows,
+            fail_threshold,
+            json_output,
+            csv_output,
+            show_loc,
+            largest_string_length,
+            fragments_reported,
+            keep_results,
+            profiler,
+        )
+        if archive:
+            archive.save(save_similarities)
 
-    if json_output:
-        similarities_json = json.dumps(code_similarity, indent=4)
-        print(similarities_json)
-
-    if csv_output:
-        with open(csv_output, "w") as csv_file:
-            writer = csv.writer(csv_file)
-            if show_loc:
-                writer.writerow(["File A", "#LoC A", "File B", "#LoC B", "Similarity"])
-                for first_file in code_similarity:
-                    for second_file in code_similarity[first_file]:
-                        if second_file != loc_label:
-                            
-                            writer.writerow(
-                                [
-                                    first_file,
-                                    get_loc_to_print(get_loc_count(os.path.join(project_root_dir, first_file))),
-                                    second_file,
-                                    get_loc_to_print(get_loc_count(os.path.join(project_root_dir, second_file))),
-                                    code_similarity[first_file][second_file][similarity_label],
-                                ]
-                            )
-            else:
-                writer.writerow(["File A", "File B", "Similarity"])
-                for first_file in code_similarity:
-                    for second_file in code_similarity[first_file]:
-                        writer.writerow(
-                            [
-                                first_file,
-                                second_file,
-                                code_similarity[first_file][second_file],
-                            ]
-                        )
+    if profile is not None:
+        report = profiler.get_report()
+        print(Profiler.format_table(report), file=sys.stderr)
+        if profile:
+            with open(profile, "w") as profile_file:
+                json.dump(Profiler.get_chrome_trace(report), profile_file, indent=4)
 
     return (exit_code, code_similarity)
 
@@ -0,0 +1,103 @@
+"""
+A thin client of a running `duplicate-code-detection --serve` server.
+
+It only depends on the standard library, so it starts almost instantly and
+is meant to be used where the tool is run often, e.g. as a pre-commit hook.
+"""
+import os
+import sys
+import json
+import socket
+import argparse
+
+default_socket_path = ".duplicate-code-detection.sock"
+bad_input_exit_code = 1
+threshold_exceeded_exit_code = 2
+
+
+def query(socket_path, request):
+    """Send a query to the server and return its response"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode() + b"\n")
+        with client.makefile("rb") as response:
+            return json.loads(response.readline())
+
+
+def print_similarities(code_similarity, show_loc):
+    for source_file, file_similarity in code_similarity.items():
+        print("Code duplication probability for " + source_file)
+        for other_file, similarity in file_similarity.items():
+            if show_loc:
+                if not isinstance(similarity, dict):
+                    continue
+                similarity = similarity["Similarity"]
+            print("    %s     %.2f" % (other_file, similarity))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report the similarities of files using a running "
+        "duplicate-code-detection --serve server."
+    )
+    parser.add_argument("query_files", nargs="*", help="The files to report.")
+    parser.add_argument(
+        "--socket",
+        default=default_socket_path,
+        help="The Unix socket the server listens on.",
+    )
+    parser.add_argument(
+        "-t",
+        "--fail-threshold",
+        type=int,
+        default=100,
+        help="The maximum allowed similarity before the script exits with an error.",
+    )
+    parser.add_argument(
+        "--ignore-threshold",
+        type=int,
+        default=0,
+        help="Don't print out similarity below the ignore threshold",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=0,
+        help="Only report the K most similar files for each file, 0 to report all of them.",
+    )
+    parser.add_argument(
+        "--show-loc", action="store_true", help="Add file line counts to the output."
+    )
+    parser.add_argument(
+        "-j", "--json", action="store_true", help="Print output as JSON."
+    )
+    args = parser.parse_args()
+
+    request = {
+        "query_files": [os.path.abspath(f) for f in args.query_files],
+        "ignore_threshold": args.ignore_threshold,
+        "fail_threshold": args.fail_threshold,
+        "top_k": args.top_k,
+        "show_loc": args.show_loc,
+    }
+    try:
+        response = query(args.socket, request)
+    except OSError as err:
+        print(f"Failed to connect to the server on {args.socket}, reason: {str(err)}")
+        print("Start one with: duplicate-code-detection --serve -d <directories>")
+        return bad_input_exit_code
+    if "error" in response:
+        print("ERROR:", response["error"])
+        return response["exit_code"]
+
+    if args.json:
+        print(json.dumps(response["similarities"], indent=4))
+    else:
+        print_similarities(response["similarities"], args.show_loc)
+        if response["exit_code"] == threshold_exceeded_exit_code:
+            print("Code duplication threshold exceeded. Please consult logs.")
+    return response["exit_code"]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
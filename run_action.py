@@ -3,6 +3,7 @@
 import os
 import sys
 import json
+import time
 import requests
 import argparse
 
@@ -11,46 +12,28 @@ import duplicate_code_detection
 WARNING_SUFFIX = " ⚠️"
 
 
-def make_markdown_table(array):
-    """Input: Python list with rows of table as lists
-               First element as header.
-        Output: String to put into a .md file
+# GitHub comments are limited to 65536 characters, leave room for the rest of the message
+max_report_size = 65000
+report_omitted_note = (
+    "\n" + WARNING_SUFFIX + " "
+    "Results were omitted because the report was too large. "
+    "Please consider ignoring results below a certain threshold.\n"
+)
 
-    Ex Input:
-        [["Name", "Age", "Height"],
-         ["Jake", 20, 5'10],
-         ["Mary", 21, 5'7]]
 
-     Adopted from: https://gist.github.com/m0neysha/219bad4b02d2008e0154
-    """
-    markdown = "\n" + str("| ")
-
-    for e in array[0]:
-        to_add = " " + str(e) + str(" |")
-        markdown += to_add
-    markdown += "\n"
-
-    markdown += "|"
-    for i in range(len(array[0])):
-        markdown += str("-------------- | ")
-    markdown += "\n"
-
-    markdown_characters = 0
-    max_characters = 65000
-    for entry in array[1:]:
-        markdown += str("| ")
-        for e in entry:
-            to_add = str(e) + str(" | ")
-            markdown += to_add
-        markdown += "\n"
-        markdown_characters += len(markdown)
-        if markdown_characters > max_characters:
-            markdown += "\n" + WARNING_SUFFIX + " "
-            markdown += "Results were omitted because the report was too large. "
-            markdown += "Please consider ignoring results below a certain threshold.\n"
-            break
+def make_markdown_header(header):
+    """Get the header line and the delimiter line of a markdown table"""
+    return (
+        "\n| "
+        + "".join(" %s |" % e for e in header)
+        + "\n|"
+        + "-------------- | " * len(header)
+        + "\n"
+    )
+
 
-    return markdown + "\n"
+def make_markdown_row(entry):
+    return "| " + "".join("%s | " % e for e in entry) + "\n"
 
 
 def get_markdown_link(file, url):
@@ -65,30 +48,213 @@ def get_warning(similarity, warn_threshold):
     )
 
 
-def similarities_to_markdown(similarities, url_prefix, warn_threshold):
-    markdown = str()
-    for checked_file in similarities.keys():
-        markdown += "<details><summary>%s</summary>\n\n" % checked_file
-        markdown += "### 📄 %s\n" % get_markdown_link(checked_file, url_prefix)
-
-        table_header = ["File", "Similarity (%)"]
-        table_contents = [
-            [get_markdown_link(f, url_prefix), get_warning(s, warn_threshold)]
-            for (f, s) in similarities[checked_file].items()
-        ]
-        # Sort table contents based on similarity
-        table_contents.sort(
-            reverse=True, key=lambda row: float(row[1].replace(WARNING_SUFFIX, ""))
+def get_similarity_value(similarity):
+    """Get the similarity percentage of an entry of the results, which is a dict
+    if the line counts or the duplicated fragments are reported too"""
+    if isinstance(similarity, dict):
+        return similarity[duplicate_code_detection.similarity_label]
+    return similarity
+
+
+def similarities_to_markdown(
+    similarities, url_prefix, warn_threshold, max_size=max_report_size
+):
+    """Render the similarities of every checked file as a collapsible table
+
+    The report is kept within max_size bytes by keeping the most similar files:
+    rows are picked in order of descending similarity across all the tables and
+    once a row does not fit, it and all the less similar ones are omitted.
+    Tables left without rows are omitted too.
+    """
+    table_header = make_markdown_header(["File", "Similarity (%)"])
+    table_end = "\n</details>\n"
+    sections = list()
+    candidate_rows = list()
+    for checked_file, file_similarity in similarities.items():
+        section_start = "<details><summary>%s</summary>\n\n" % checked_file
+        section_start += "### 📄 %s\n" % get_markdown_link(checked_file, url_prefix)
+        for other_file, similarity in file_similarity.items():
+            if other_file == duplicate_code_detection.loc_label:
+                continue
+            similarity = get_similarity_value(similarity)
+            candidate_rows.append((-similarity, len(sections), other_file, similarity))
+        sections.append((section_start + table_header, list()))
+    # Most similar files first, in the order of the tables and of the files otherwise
+    candidate_rows.sort(key=lambda row: (row[0], row[1]))
+
+    budget = max_size - len(report_omitted_note.encode())
+    report_size = 0
+    omitted_rows = 0
+    for row_index, (_, section_index, other_file, similarity) in enumerate(candidate_rows):
+        section_start, rows = sections[section_index]
+        row = make_markdown_row(
+            [
+                get_markdown_link(other_file, url_prefix),
+                get_warning(similarity, warn_threshold),
+            ]
         )
-        entire_table = [[] for _ in range(len(table_contents) + 1)]
-        entire_table[0] = table_header
-        for i in range(1, len(table_contents) + 1):
-            entire_table[i] = table_contents[i - 1]
+        row_size = len(row.encode())
+        if not rows:
+            row_size += len(section_start.encode()) + len(table_end)
+        if report_size + row_size > budget:
+            omitted_rows = len(candidate_rows) - row_index
+            break
+        report_size += row_size
+        rows.append(row)
+
+    markdown = list()
+    for section_start, rows in sections:
+        if rows:
+            markdown.append(section_start)
+            markdown.extend(rows)
+            markdown.append(table_end)
+    if omitted_rows:
+        markdown.append(report_omitted_note)
+    return "".join(markdown)
+
+
+class GitHubClient:
+    """A small client of the GitHub REST API, sharing its connections across requests
+
+    Requests that hit a rate limit (403 or 429) are retried with backoff, and so
+    are the ones that fail temporarily (5xx or connection errors), unless they
+    are POST requests, which may have taken effect anyway. GET requests are conditional,
+    using the ETag of the previous response of the same URL, so unchanged
+    resources are served from memory without counting against the rate limit.
+    """
 
-        markdown += make_markdown_table(entire_table)
-        markdown += "</details>\n"
+    page_size = 100
+    max_retries = 5
+    max_backoff = 60
+
+    def __init__(self, api_url, repository, token, session=None, sleep=time.sleep):
+        self.api_url = api_url.rstrip("/")
+        self.repository = repository
+        self.session = session or requests.Session()
+        self.session.headers.update(
+            {
+                "Authorization": "token %s" % token,
+                "Accept": "application/vnd.github+json",
+            }
+        )
+        self.sleep = sleep
+        self.cached_responses = dict()
+
+    def get_retry_delay(self, response, attempt, idempotent):
+        """Get how long to wait before retrying a request, or None if the response
+        is final"""
+        if response is None:
+            # The connection failed
+            return min(2**attempt, self.max_backoff) if idempotent else None
+        rate_limited = response.status_code == 429 or (
+            response.status_code == 403
+            and (
+                "Retry-After" in response.headers
+                or response.headers.get("X-RateLimit-Remaining") == "0"
+            )
+        )
+        if not rate_limited and (response.status_code < 500 or not idempotent):
+            return None
+        if "Retry-After" in response.headers:
+            return min(float(response.headers["Retry-After"]), self.max_backoff)
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            reset_time = float(response.headers.get("X-RateLimit-Reset", 0))
+            return min(max(reset_time - time.time(), 1), self.max_backoff)
+        return min(2**attempt, self.max_backoff)
+
+    def request(self, method, url, **kwargs):
+        """Send a request, retrying it on rate limits and temporary failures"""
+        idempotent = method != "POST"
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                response = self.session.request(method, url, timeout=30, **kwargs)
+            except requests.ConnectionError:
+                if attempt == self.max_retries or not idempotent:
+                    raise
+            delay = self.get_retry_delay(response, attempt, idempotent)
+            if delay is None or attempt == self.max_retries:
+                return response
+            print("GitHub API request failed, retrying in %.0f seconds" % delay)
+            self.sleep(delay)
+
+    def get(self, url, params=None):
+        """Get a resource, reusing the cached response if it has not changed"""
+        key = (url, tuple(sorted((params or dict()).items())))
+        headers = dict()
+        if key in self.cached_responses:
+            headers["If-None-Match"] = self.cached_responses[key].headers["ETag"]
+        response = self.request("GET", url, params=params, headers=headers)
+        if response.status_code == 304:
+            return self.cached_responses[key]
+        if response.status_code == 200 and "ETag" in response.headers:
+            self.cached_responses[key] = response
+        return response
+
+    def get_comments_url(self, issue_number):
+        return "%s/repos/%s/issues/%s/comments" % (
+            self.api_url,
+            self.repository,
+            issue_number,
+        )
 
-    return markdown
+    def iterate_comments_newest_first(self, issue_number):
+        """Yield the comments of an issue or pull request, from the newest one
+
+        The API lists comments from the oldest one, so the first page is only
+        fetched to find the last one through the Link header. The pages are then
+        fetched backwards, following the "prev" links, only as long as comments
+        are consumed.
+        """
+        first_page = self.get(
+            self.get_comments_url(issue_number), {"per_page": self.page_size}
+        )
+        first_page.raise_for_status()
+        page_link = first_page.links.get("last")
+        while page_link is not None:
+            page = self.get(page_link["url"])
+            page.raise_for_status()
+            yield from reversed(page.json())
+            page_link = page.links.get("prev")
+            # The first page has been fetched already. The links of a page differ
+            # by their rel, so they are compared by their URL.
+            first_link = page.links.get("first")
+            if page_link is None or (
+                first_link is not None and page_link["url"] == first_link["url"]
+            ):
+                break
+        yield from reversed(first_page.json())
+
+    def find_comment(self, issue_number, predicate):
+        """Get the newest comment of an issue or pull request matching the predicate"""
+        for comment in self.iterate_comments_newest_first(issue_number):
+            if predicate(comment):
+                return comment
+        return None
+
+    def post_comment(self, issue_number, body):
+        return self.request(
+            "POST", self.get_comments_url(issue_number), json={"body": body}
+        )
+
+    def update_comment(self, comment_url, body):
+        return self.request("PATCH", comment_url, json={"body": body})
+
+
+def read_results(results_file, fail_threshold):
+    """Read the JSON output of the tool, e.g. merged from shards, and get the
+    return code of the run that produced it"""
+    with open(results_file) as f:
+        code_similarity = json.load(f)
+    threshold_exceeded = any(
+        get_similarity_value(similarity) > fail_threshold
+        for file_similarity in code_similarity.values()
+        for other_file, similarity in file_similarity.items()
+        if other_file != duplicate_code_detection.loc_label
+    )
+    if threshold_exceeded:
+        return (duplicate_code_detection.ReturnCode.THRESHOLD_EXCEEDED, code_similarity)
+    return (duplicate_code_detection.ReturnCode.SUCCESS, code_similarity)
 
 
 def split_and_trim(input_list):
@@ -112,6 +278,12 @@ def main():
     parser.add_argument(
         "--pull-request-id", type=str, required=True, help="The pull request id"
     )
+    parser.add_argument(
+        "--changed-files-list",
+        type=str,
+        help="A file with the paths of the files changed by the pull request, "
+        "separated by null characters",
+    )
     args = parser.parse_args()
 
     fail_threshold = os.environ.get("INPUT_FAIL_ABOVE")
@@ -121,6 +293,10 @@ def main():
     file_extensions = os.environ.get("INPUT_FILE_EXTENSIONS")
     ignore_threshold = os.environ.get("INPUT_IGNORE_BELOW")
     only_code = os.environ.get("INPUT_ONLY_CODE")
+    tokenizer = os.environ.get("INPUT_TOKENIZER", "nltk")
+    only_changed_files = os.environ.get(
+        "INPUT_ONLY_CHANGED_FILES", "false"
+    ).lower() in ("true", "1")
 
     directories_list = split_and_trim(directories)
     directories_list = to_absolute_path(directories_list)
@@ -137,20 +313,41 @@ def main():
     csv_output_path = ""  # No CSV output by default for now in GitHub Actions
     show_loc = False
 
-    detection_result, code_similarity = duplicate_code_detection.run(
-        int(fail_threshold),
-        directories_list,
-        files_list,
-        ignore_directories_list,
-        ignore_files_list,
-        json_output,
-        project_root_dir,
-        file_extensions_list,
-        int(ignore_threshold),
-        bool(only_code),
-        csv_output_path,
-        show_loc,
-    )
+    query_files = None
+    if only_changed_files:
+        if args.changed_files_list:
+            with open(args.changed_files_list) as f:
+                changed_files = [path for path in f.read().split("\0") if path]
+            query_files = to_absolute_path(changed_files)
+        else:
+            print("The changed files are unknown, reporting all the files instead")
+
+    results_file = os.environ.get("INPUT_RESULTS_FILE", "")
+    if results_file:
+        # Relative paths are relative to the workspace of the workflow
+        results_file = os.path.join(os.environ.get("GITHUB_WORKSPACE", ""), results_file)
+        detection_result, code_similarity = read_results(
+            results_file, int(fail_threshold)
+        )
+    else:
+        detection_result, code_similarity = duplicate_code_detection.run(
+            int(fail_threshold),
+            directories_list,
+            files_list,
+            ignore_directories_list,
+            ignore_files_list,
+            json_output,
+            project_root_dir,
+            file_extensions_list,
+            int(ignore_threshold),
+            bool(only_code),
+            csv_output_path,
+            show_loc,
+            query_files=query_files,
+            tokenizer=tokenizer,
+            # The pull request has just been cloned, so its files are read from git
+            git=True,
+        )
 
     if detection_result == duplicate_code_detection.ReturnCode.BAD_INPUT:
         print("Action aborted due to bad user input")
@@ -170,22 +367,15 @@ def main():
     message += " analyzed your source code and found the following degree of"
     message += " similarity between the files:\n"
     message += similarities_to_markdown(
-        code_similarity, files_url_prefix, warn_threshold
+        code_similarity,
+        files_url_prefix,
+        warn_threshold,
+        max_report_size - len(message.encode()),
     )
 
     github_token = os.environ.get("INPUT_GITHUB_TOKEN")
     github_api_url = os.environ.get("GITHUB_API_URL")
-
-    request_url = "%s/repos/%s/issues/%s/comments" % (
-        github_api_url,
-        repo,
-        args.pull_request_id,
-    )
-
-    headers = {
-        "Authorization": "token %s" % github_token,
-    }
-    report = {"body": message}
+    github = GitHubClient(github_api_url, repo, github_token)
 
     update_existing_comment = os.environ.get("INPUT_ONE_COMMENT", "false").lower() in (
         "true",
@@ -194,31 +384,24 @@ def main():
     comment_updated = False
     if update_existing_comment:
         # If the bot has posted many comments, update the last one
-        pr_comments = requests.get(request_url, headers=headers).json()
-        for pr_comment in pr_comments[::-1]:
-            if pr_comment["body"].startswith(header_message_start):
-                update_result = requests.patch(
-                    pr_comment["url"],
-                    json=report,
-                    headers=headers,
+        pr_comment = github.find_comment(
+            args.pull_request_id,
+            lambda comment: comment["body"].startswith(header_message_start),
+        )
+        if pr_comment is not None:
+            update_result = github.update_comment(pr_comment["url"], message)
+            if update_result.status_code != 200:
+                print(
+                    "Updating existing comment failed with code: "
+                    + str(update_result.status_code)
                 )
-                if update_result.status_code != 200:
-                    print(
-                        "Updating existing comment failed with code: "
-                        + str(update_result.status_code)
-                    )
-                    print(update_result.text)
-                    print("Attempting to post a new comment instead")
-                else:
-                    comment_updated = True
-                break
+                print(update_result.text)
+                print("Attempting to post a new comment instead")
+            else:
+                comment_updated = True
 
     if not comment_updated:
-        post_result = requests.post(
-            request_url,
-            json=report,
-            headers=headers,
-        )
+        post_result = github.post_comment(args.pull_request_id, message)
 
         if post_result.status_code != 201:
             print(
@@ -3,16 +3,20 @@ from setuptools import setup
 setup(
     name='duplicate code detection tool',
     entry_points={
-        'console_scripts': ['duplicate-code-detection=duplicate_code_detection:main']
+        'console_scripts': [
+            'duplicate-code-detection=duplicate_code_detection:main',
+            'duplicate-code-detection-client=duplicate_code_detection_client:main',
+        ]
     },
-    py_modules=['duplicate_code_detection'],
+    py_modules=['duplicate_code_detection', 'duplicate_code_detection_client'],
     package_dir={
         'duplicate_code_detection': '.',
     },
     install_requires=[
         'gensim>=3.8',
         'nltk>=3.5',
-        'astor>=0.8.1'
+        'numpy>=1.13',
+        'scipy>=1.0',
     ],
     setuptools_git_versioning={
         "enabled": True,
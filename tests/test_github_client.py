@@ -0,0 +1,119 @@
+"""Tests of the GitHub API client of run_action.py against a local HTTP stand-in"""
+
+import json
+import os
+import sys
+import threading
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import run_action  # noqa: E402
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serve the comments of any issue, paginated like the GitHub API"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        server.requests.append((self.path, self.headers.get("If-None-Match")))
+        if server.rate_limited_requests > 0:
+            server.rate_limited_requests -= 1
+            self.send_response(403)
+            self.send_header("X-RateLimit-Remaining", "0")
+            self.send_header("X-RateLimit-Reset", "0")
+            self.end_headers()
+            return
+        per_page = int(query.get("per_page", ["30"])[0])
+        page = int(query.get("page", ["1"])[0])
+        last_page = max(1, -(-len(server.comments) // per_page))
+        etag = '"%d-%d"' % (page, len(server.comments))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        def make_link(link_page, rel):
+            return '<http://%s:%d%s?per_page=%d&page=%d>; rel="%s"' % (
+                server.server_address + (url.path, per_page, link_page, rel)
+            )
+
+        links = list()
+        if page < last_page:
+            links += [make_link(page + 1, "next"), make_link(last_page, "last")]
+        if page > 1:
+            links += [make_link(page - 1, "prev"), make_link(1, "first")]
+        body = json.dumps(server.comments[(page - 1) * per_page : page * per_page])
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        if links:
+            self.send_header("Link", ", ".join(links))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+
+class GitHubClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.server.comments = [{"id": i, "body": "comment %d" % i} for i in range(250)]
+        self.server.requests = list()
+        self.server.rate_limited_requests = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.delays = list()
+        self.client = run_action.GitHubClient(
+            "http://%s:%d" % self.server.server_address,
+            "owner/repository",
+            "token",
+            sleep=self.delays.append,
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.client.session.close()
+
+    def get_requested_pages(self):
+        return [
+            urllib.parse.parse_qs(urllib.parse.urlparse(path).query).get("page", ["1"])[0]
+            for path, _ in self.server.requests
+        ]
+
+    def test_comments_are_yielded_once_newest_first(self):
+        comments = list(self.client.iterate_comments_newest_first(1))
+        self.assertEqual([c["id"] for c in comments], list(range(249, -1, -1)))
+        self.assertEqual(self.get_requested_pages(), ["1", "3", "2"])
+
+    def test_single_page(self):
+        self.server.comments = self.server.comments[:10]
+        comments = list(self.client.iterate_comments_newest_first(1))
+        self.assertEqual([c["id"] for c in comments], list(range(9, -1, -1)))
+        self.assertEqual(self.get_requested_pages(), ["1"])
+
+    def test_search_stops_at_the_newest_match(self):
+        comment = self.client.find_comment(1, lambda c: c["id"] % 100 == 42)
+        self.assertEqual(comment["id"], 242)
+        self.assertEqual(self.get_requested_pages(), ["1", "3"])
+
+    def test_rate_limited_request_is_retried(self):
+        self.server.rate_limited_requests = 2
+        comment = self.client.find_comment(1, lambda c: True)
+        self.assertEqual(comment["id"], 249)
+        self.assertEqual(len(self.delays), 2)
+
+    def test_unchanged_pages_are_served_from_cache(self):
+        list(self.client.iterate_comments_newest_first(1))
+        del self.server.requests[:]
+        comments = list(self.client.iterate_comments_newest_first(1))
+        self.assertEqual(len(comments), 250)
+        self.assertTrue(all(etag for _, etag in self.server.requests))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+"""Tests comparing the results of the similarity engines of duplicate_code_detection.py"""
+
+import contextlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import duplicate_code_detection  # noqa: E402
+
+words = [
+    "alpha", "beta", "gamma", "delta", "return", "if", "for", "x", "y",
+    "count", "index", "value", "self", "None", "print",
+]
+
+
+def write_fixture_tree(directory):
+    """Write a few random source files and an exact copy of one of them. With
+    this seed, the TF-IDF similarity of the copy is computed as slightly above 1"""
+    rng = random.Random(5)
+    for i in range(4):
+        lines = [
+            " ".join(rng.choice(words) for _ in range(rng.randint(3, 8)))
+            for _ in range(rng.randint(5, 15))
+        ]
+        with open(os.path.join(directory, "f%d.py" % i), "w") as f:
+            f.write("\n".join(lines))
+    shutil.copy(os.path.join(directory, "f0.py"), os.path.join(directory, "g_copy.py"))
+
+
+class SimilarityEnginesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        write_fixture_tree(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_tool(self, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return duplicate_code_detection.run(
+                100,
+                [self.directory],
+                None,
+                [],
+                None,
+                True,
+                self.directory,
+                ["py"],
+                0,
+                False,
+                "",
+                False,
+                tokenizer="code",
+                **kwargs
+            )
+
+    def test_engines_agree_with_gensim_disk_index(self):
+        exit_code, code_similarity = self.run_tool(
+            similarity_engine="gensim", index_backend="disk"
+        )
+        self.assertEqual(exit_code, duplicate_code_detection.ReturnCode.SUCCESS)
+        self.assertEqual(code_similarity["f0.py"]["g_copy.py"], 100.0)
+        for engine, index_backend in [("gensim", "memory"), ("matrix", "auto")]:
+            with self.subTest(engine=engine, index_backend=index_backend):
+                self.assertEqual(
+                    self.run_tool(similarity_engine=engine, index_backend=index_backend),
+                    (exit_code, code_similarity),
+                )
+
+    def test_identical_files_are_not_more_than_100_percent_similar(self):
+        for kwargs in [
+            dict(similarity_engine="gensim", index_backend="memory"),
+            dict(similarity_engine="matrix"),
+            dict(similarity_engine="matrix", top_k=2),
+            dict(top_k=2, top_k_method="minhash"),
+        ]:
+            with self.subTest(**kwargs):
+                exit_code, code_similarity = self.run_tool(**kwargs)
+                self.assertEqual(exit_code, duplicate_code_detection.ReturnCode.SUCCESS)
+                self.assertLessEqual(
+                    max(max(s.values()) for s in code_similarity.values()), 100.0
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()